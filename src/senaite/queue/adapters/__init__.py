@@ -55,7 +55,9 @@ class QueuedActionTaskAdapter(object):
         # Add remaining objects to the queue and keep properties
         due = chunks[1]
         if due:
-            api.add_copy(task, context=self.context, uids=due, unique=False)
+            chunk = task.get("chunk", 1) + 1
+            api.add_copy(task, context=self.context, uids=due, unique=False,
+                         chunk=chunk)
 
 
 class QueuedAssignAnalysesTaskAdapter(object):
@@ -115,7 +117,9 @@ class QueuedAssignAnalysesTaskAdapter(object):
         if chunks[1]:
             # Unpack the remaining analyses-slots and add them to the queue
             uids, slots = zip(*chunks[1])
-            api.add_copy(task, context=self.context, uids=uids, slots=slots)
+            chunk = task.get("chunk", 1) + 1
+            api.add_copy(task, context=self.context, uids=uids, slots=slots,
+                         chunk=chunk)
 
 
 class QueueObjectSecurityAdapter(object):
@@ -150,6 +154,7 @@ class QueueObjectSecurityAdapter(object):
             kwargs = {
                 "top_uid": top_uid,
                 "priority": task.priority,
+                "chunk": task.get("chunk", 1) + 1,
             }
             api.add_reindex_obj_security_task(oldest_uid, **kwargs)
 
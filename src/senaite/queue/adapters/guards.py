@@ -51,12 +51,10 @@ class SampleGuardAdapter(object):
         if api.is_queued(self.context, status=["queued"]):
             return False
 
-        # Check whether the sample contains queued analyses
-        for brain in self.context.getAnalyses():
-            if api.is_queued(brain, status=["queued"]):
-                return False
-
-        return True
+        # Check whether the sample contains queued analyses. Analyses are
+        # returned as brains, so objects are not woken up
+        analyses = self.context.getAnalyses()
+        return not api.any_queued(analyses, status=["queued"])
 
 
 class WorksheetGuardAdapter(object):
@@ -76,9 +74,7 @@ class WorksheetGuardAdapter(object):
         if api.is_queued(self.context, status=["queued"]):
             return False
 
-        # Check whether this worksheet contains queued analyses
-        for obj in self.context.getAnalyses():
-            if api.is_queued(obj, status=["queued"]):
-                return False
-
-        return True
+        # Check whether this worksheet contains queued analyses. Use the uids
+        # of the analyses, so objects are not woken up
+        analyses = self.context.getRawAnalyses()
+        return not api.any_queued(analyses, status=["queued"])
@@ -21,6 +21,7 @@
 from Acquisition import aq_base  # noqa
 from collections import OrderedDict
 from plone.memoize import ram
+from zope.annotation.interfaces import IAnnotations
 from senaite.queue import is_installed
 from senaite.queue.interfaces import IClientQueueUtility
 from senaite.queue.interfaces import IQueuedTaskAdapter
@@ -35,6 +36,9 @@ from zope.component import queryAdapter
 from bika.lims import api as _api
 from bika.lims.interfaces import IWorksheet
 
+# Key of the request annotation where the uids from the queue are memoized
+QUEUED_UIDS_KEY = "senaite.queue.queued_uids"
+
 
 def get_server_url():
     """Returns the url of the queue server if valid. None otherwise.
@@ -121,7 +125,59 @@ def is_queued(brain_object_uid, status=None):
         return False
 
     uid = _api.get_uid(brain_object_uid)
-    return uid in get_queue().get_uids(status=status)
+    return uid in get_queued_uids(status=status)
+
+
+def any_queued(brains_objects_uids, status=None):
+    """Returns whether any of the objects passed-in is queued. Prefer uids or
+    brains over objects, so objects are not woken up just for this check
+    :param brains_objects_uids: list of objects, brains or uids to check for
+    :param status: (Optional) if None, looks to tasks either queued or running
+    :return: True if any of the objects is in the queue
+    """
+    if not is_queue_enabled():
+        return False
+
+    queued = get_queued_uids(status=status)
+    if not queued:
+        return False
+
+    uids = map(_api.get_uid, brains_objects_uids)
+    return not queued.isdisjoint(uids)
+
+
+def get_queued_uids(status=None):
+    """Returns the uids of the objects the queue contains, either as the
+    context of a task or as one of the uids of a task. The uids are computed
+    once per request and status, and computed again only when the queue
+    changes, so checks for many objects (e.g. rows of a listing) do not
+    traverse the whole queue each time
+    :param status: (Optional) a string or list with status. If None, only
+        "running" and "queued" are considered
+    :return: the uids from the queue
+    :rtype: frozenset
+    """
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    status = tuple(sorted(filter(None, status)))
+
+    queue = get_queue()
+    revision = queue.get_revision()
+
+    request = _api.get_request()
+    cache = IAnnotations(request, None)
+    if cache is None:
+        # No request, or request cannot be annotated
+        return frozenset(queue.iter_uids(status=status))
+
+    memo = cache.setdefault(QUEUED_UIDS_KEY, {})
+    cached = memo.get(status)
+    if cached and cached[0] == revision:
+        return cached[1]
+
+    uids = frozenset(queue.iter_uids(status=status))
+    memo[status] = (revision, uids)
+    return uids
 
 
 def add_task(name, context, **kwargs):
@@ -351,13 +407,15 @@ def get_queue():
     """Returns the queue utility
     """
     if is_queue_server():
-        # Return the server's queue utility
+        # Return the server's queue utility, with the tasks from the journal
         utility = getUtility(IServerQueueUtility)
+        utility.recover()
     else:
         # Return the client's queue utility
         utility = getUtility(IClientQueueUtility)
-        if utility.is_out_of_date():
-            # Sync the queue if needed
-            utility.sync()
+
+        # Keep the local pool of tasks up-to-date in background, so there is
+        # no need to wait for the queue server while handling the request
+        utility.listen()
 
     return utility
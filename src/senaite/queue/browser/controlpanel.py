@@ -54,6 +54,10 @@ def valid_url_constraint(value):
 # Default number of objects per task
 DEFAULT_OBJ_TASK = 10
 
+# Settings no longer used. They are kept in the registry for backwards
+# compatibility, but are not displayed in the control panel
+DEPRECATED_FIELDS = ["min_seconds_task"]
+
 
 class IQueueControlPanel(Interface):
     """Control panel Settings
@@ -111,13 +115,10 @@ class IQueueControlPanel(Interface):
     min_seconds_task = schema.Int(
         title=_(u"Minimum seconds"),
         description=_(
-            "Minimum number of seconds to book per task. If the task is "
-            "performed very rapidly, it will have priority over a transaction "
-            "done from userland. In case of conflict, the transaction from "
-            "userland will fail and will be retried up to 3 times. This "
-            "setting makes the thread that handles the task to take some time "
-            "to complete, thus preventing threads from userland to be delayed "
-            "or fail. Default value: 3"
+            "Deprecated, no longer used. Tasks are only sent to the queue "
+            "once the transaction from userland that created them has been "
+            "committed, so consumers do not need to wait before or after "
+            "processing a task"
         ),
         min=3,
         max=30,
@@ -172,12 +173,121 @@ class IQueueControlPanel(Interface):
         ],
     )
 
+    consumer_workers = schema.Int(
+        title=_(u"Consumer workers"),
+        description=_(
+            "Number of tasks each zeo client acting as a consumer processes "
+            "at the same time, each one in its own thread. Higher values "
+            "increase the throughput of the queue on zeo clients with several "
+            "cores available, but also the chance of transaction commit "
+            "conflicts. Default value: 1"
+        ),
+        min=1,
+        max=16,
+        default=1,
+        required=True,
+    )
+
+    consumer_prefetch = schema.Int(
+        title=_(u"Tasks per pull"),
+        description=_(
+            "Max number of tasks each consumer worker pulls from the queue "
+            "server at once. The worker processes these tasks one after the "
+            "other and acknowledges them all together afterwards. Higher "
+            "values reduce the number of requests against the queue server "
+            "when there are many small tasks, but a slow task delays the "
+            "ones pulled with it. Default value: 1"
+        ),
+        min=1,
+        max=20,
+        default=1,
+        required=True,
+    )
+
+    min_concurrency = schema.Int(
+        title=_(u"Min concurrent tasks"),
+        description=_(
+            "Min number of tasks the queue server allows to be processed at "
+            "the same time. The queue server adapts the number of concurrent "
+            "tasks between this value and the max: the number increases while "
+            "tasks are processed successfully and decreases when tasks fail "
+            "(e.g. because of transaction commit conflicts) or take much "
+            "longer than usual. Default value: 1"
+        ),
+        min=1,
+        max=100,
+        default=1,
+        required=True,
+    )
+
+    max_concurrency = schema.Int(
+        title=_(u"Max concurrent tasks"),
+        description=_(
+            "Max number of tasks the queue server allows to be processed at "
+            "the same time. Default value: 16"
+        ),
+        min=1,
+        max=100,
+        default=16,
+        required=True,
+    )
+
+    long_poll_clients = schema.Int(
+        title=_(u"Long-polling clients"),
+        description=_(
+            "Max number of zeo clients whose requests for changes the queue "
+            "server holds at a time until the queue changes (long-polling). "
+            "Each request held keeps a thread of the queue server busy, so "
+            "the queue server never holds more requests than the number of "
+            "its threads (zserver-threads) minus one. Other clients fall back "
+            "to asking for changes every few seconds. Set it to the number of "
+            "zeo clients and increase the threads of the queue server "
+            "accordingly for all clients to be notified right away. Default "
+            "value: 0 (no long-polling)"
+        ),
+        min=0,
+        max=100,
+        default=0,
+        required=True,
+    )
+
+    http_pool_size = schema.Int(
+        title=_(u"HTTP connections pool size"),
+        description=_(
+            "Number of connections to the queue server and consumers each zeo "
+            "client keeps alive for reuse, so a new connection is not opened "
+            "on every request. Default value: 10"
+        ),
+        min=1,
+        max=100,
+        default=10,
+        required=True,
+    )
+
+    http_max_retries = schema.Int(
+        title=_(u"HTTP connection retries"),
+        description=_(
+            "Number of times a zeo client retries to connect to the queue "
+            "server or to a consumer before giving up. Retries are delayed "
+            "with an exponential backoff. A value of 0 disables retries. "
+            "Default value: 3"
+        ),
+        min=0,
+        max=10,
+        default=3,
+        required=True,
+    )
+
 
 class QueueControlPanelForm(RegistryEditForm):
     schema = IQueueControlPanel
     schema_prefix = "senaite.queue"
     label = _("SENAITE QUEUE Settings")
 
+    def updateFields(self):
+        super(QueueControlPanelForm, self).updateFields()
+        self.fields = self.fields.omit(*DEPRECATED_FIELDS)
+
 
 QueueControlPanelView = layout.wrap_form(QueueControlPanelForm,
                                          ControlPanelFormWrapper)
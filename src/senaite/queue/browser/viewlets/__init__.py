@@ -19,13 +19,15 @@
 # Some rights reserved, see README and LICENSE.
 
 import itertools
-import requests
 import time
 from plone.app.layout.viewlets import ViewletBase
 from plone.memoize import ram
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from senaite.queue import api
 from senaite.queue import is_installed
+from senaite.queue.session import get_max_retries
+from senaite.queue.session import get_pool_size
+from senaite.queue.session import get_session
 
 
 class QueuedAnalysesViewlet(ViewletBase):
@@ -115,7 +117,8 @@ class QueueServerStatusViewlet(ViewletBase):
         url = "{}/@@API/senaite/v1/version".format(server_url)
         try:
             # Check the request was successful. Raise exception otherwise
-            r = requests.get(url, timeout=1)
+            session = get_session(get_pool_size(), get_max_retries())
+            r = session.get(url, timeout=1)
             r.raise_for_status()
             return "ok"
         except:  # noqa don't care about the response, want a ping only
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from Products.Five.browser import BrowserView
+from senaite.queue import api
+
+
+class MetricsView(BrowserView):
+    """View that returns the metrics of the queue in Prometheus text format.
+    Only available in the zeo client that acts as the queue server
+    """
+
+    def __call__(self):
+        response = self.request.response
+        if not api.is_queue_server():
+            response.setStatus(405)
+            return "Not a Queue Server"
+
+        metrics = api.get_queue().get_metrics()
+        response.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return metrics.to_prometheus()
@@ -18,15 +18,12 @@
 # Copyright 2019-2021 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-from operator import itemgetter
-
 import collections
 from datetime import datetime
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from senaite.core.listing import ListingView
 from senaite.queue import api as qapi
 from senaite.queue import messageFactory as _
-from senaite.queue.queue import get_max_retries
 from zope.component.interfaces import implements
 
 from bika.lims import api
@@ -177,18 +174,26 @@ class TasksListingView(ListingView):
         elif self.review_state.get("id") == "all":
             status = ["running", "queued", "failed", "ghost"]
 
-        items = map(self.make_item, qapi.get_queue().get_tasks(status=status))
+        # Sort by the position in the queue unless sorted by another column
+        sort_on = self.manual_sort_on
+        if sort_on not in self.columns.keys() or sort_on == "priority":
+            sort_on = None
+
+        # Get the visible page of tasks only. The queue does the filtering,
+        # sorting and pagination, so the rest of tasks are never fetched
+        queue = qapi.get_queue()
+        tasks, self.total = queue.get_tasks_page(
+            status=status, sort_on=sort_on, sort_order=self.get_sort_order(),
+            offset=self.get_limit_from(), limit=self.pagesize)
+        items = map(self.make_item, tasks)
 
-        # Infere the priorities
         site_url = api.get_url(api.get_portal())
         api_url = "{}/@@API/v1/@@API/senaite/v1/queue_server".format(site_url)
-        idx = 1
         for item in items:
-            if item["status"] not in ["queued", "running"]:
-                priority = 0
-            else:
-                priority = idx
-                idx += 1
+            # Infere the priority from the position of the task in the queue
+            priority = 0
+            if item["status"] in ["queued", "running"]:
+                priority = item["position"]
 
             created = datetime.fromtimestamp(int(item["created"])).isoformat()
             context_link = get_link(item["context_path"], item["context_path"])
@@ -214,17 +219,7 @@ class TasksListingView(ListingView):
                  }}
             )
 
-        # Sort the items
-        sort_on = self.manual_sort_on in self.columns.keys() or "priority"
-        reverse = self.get_sort_order() == "ascending"
-        items = sorted(items, key=itemgetter(sort_on), reverse=reverse)
-
-        # Pagination
-        self.total = len(items)
-        limit_from = self.get_limit_from()
-        if limit_from and len(items) > limit_from:
-            return items[limit_from:self.pagesize + limit_from]
-        return items[:self.pagesize]
+        return items
 
     def make_empty_item(self, **kw):
         """Creates an empty listing item
@@ -257,6 +252,7 @@ class TasksListingView(ListingView):
             "context_path": task.context_path,
             "username": task.username,
             "status": task.status,
+            "position": task.get("position", 0),
             "ghost": task.get("ghost") or False,
             "disabled": task.status in ["running", ]
         })
@@ -289,11 +285,7 @@ class WorkflowActionRequeueAdapter(RequestContextAware):
         """Re-queues the selected tasks and redirects to the previous URL
         """
         queue = qapi.get_queue()
-        for uid in uids:
-            task = queue.get_task(uid)
-            task.retries = get_max_retries()
-            queue.delete(uid)
-            queue.add(task)
+        map(queue.requeue, uids)
 
         url = api.get_url(api.get_portal())
         url = "{}/queue_tasks".format(url)
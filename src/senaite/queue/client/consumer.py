@@ -20,27 +20,62 @@
 
 import threading
 import time
-import requests
 
 from senaite.queue import api
 from senaite.queue import is_installed
 from senaite.queue import logger
+from senaite.queue.client.executor import execute_task
+from senaite.queue.client.executor import TaskTimeout
+from senaite.queue.queue import get_consumer_id
+from senaite.queue.queue import get_consumer_prefetch
+from senaite.queue.queue import get_consumer_workers
 from senaite.queue.queue import get_max_seconds
+from senaite.queue.queue import LEASE_TTL
 from senaite.queue.pasplugin import QueueAuth
 from senaite.queue.request import is_valid_zeo_host
+from senaite.queue.session import get_max_retries
+from senaite.queue.session import get_pool_size
+from senaite.queue.session import get_session
 
 from bika.lims import api as _api
 from bika.lims.decorators import synchronized
-from requests.exceptions import Timeout
 from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
+from requests.exceptions import Timeout
 
 
 CONSUMER_THREAD_PREFIX = "queue.consumer."
 
+# Prefix of the threads the tasks are processed within, so the worker can stop
+# waiting for a task that exceeds the max number of seconds
+EXECUTOR_THREAD_PREFIX = "queue.executor."
+
+# Seconds between heartbeats to renew the lease of the tasks being processed,
+# so a lost heartbeat does not make the lease to expire
+HEARTBEAT_INTERVAL = LEASE_TTL / 3.0
+
+# Seconds a worker waits before pulling again when the queue is empty, that
+# are doubled on each attempt up to the max
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 5
+
+# Seconds a worker keeps pulling from an empty queue before it stops. The
+# worker is started again on next consume request
+MAX_IDLE = 60
+
+# Max number of attempts to acknowledge the tasks processed when the queue
+# server cannot be reached or is busy. The lease of the tasks is renewed in
+# the meantime, so they are not re-queued and processed again
+ACK_MAX_ATTEMPTS = 20
+
 
 @synchronized(max_connections=1)
 def consume_task():
-    """Consumes a task from the queue, if any
+    """Consumes tasks from the queue, if any. Pops the tasks for each idle
+    worker this consumer has and starts a thread for each one. Each worker
+    keeps pulling tasks from the queue on its own once the task is processed,
+    so this function only needs to be called to start the workers that are
+    not running (e.g. by a clock server)
     """
     if not is_installed():
         return info("Queue is not installed")
@@ -49,11 +84,11 @@ def consume_task():
     if not is_valid_zeo_host(host):
         return error("zeo host not set or not valid: {} [SKIP]".format(host))
 
-    consumer_thread = get_consumer_thread()
-    if consumer_thread:
-        # There is a consumer working already
-        name = consumer_thread.getName()
-        return info("Consumer running: {} [SKIP]".format(name))
+    workers = get_consumer_workers()
+    idle_workers = get_idle_workers(workers)
+    if not idle_workers:
+        # All workers are busy
+        return info("Consumers running: {} [SKIP]".format(workers))
 
     logger.info("Queue client: {}".format(host))
 
@@ -78,116 +113,357 @@ def consume_task():
         ]
         logger.warn("\n".join(message))
 
-    # Pop next task to process
-    consumer_id = host
-    try:
-        task = api.get_queue().pop(consumer_id)
-        if not task:
-            return info("Queue is empty or process undergoing [SKIP]")
-    except Exception as e:
-        return error("Cannot pop. {}: {}".format(type(e).__name__, str(e)))
-
     auth_key = _api.get_registry_record("senaite.queue.auth_key")
     kwargs = {
-        "task_uid": task.task_uid,
-        "task_username": task.username,
-        "consumer_id": consumer_id,
         "base_url": _api.get_url(_api.get_portal()),
         "server_url": api.get_server_url(),
         "user_id": _api.get_current_user().id,
         "max_seconds": get_max_seconds(),
         "auth_key": auth_key,
+        "http_pool_size": get_pool_size(),
+        "http_max_retries": get_max_retries(),
+        "db": _api.get_portal()._p_jar.db(),
+        "site_path": _api.get_path(_api.get_portal()),
+        "prefetch": get_consumer_prefetch(),
     }
-    name = "{}{}".format(CONSUMER_THREAD_PREFIX, int(time.time()))
-    t = threading.Thread(name=name, target=process_task, kwargs=kwargs)
-    t.start()
 
-    return info("Consumer running: {} [SKIP]".format(CONSUMER_THREAD_PREFIX))
+    # Pop the next tasks to process for each idle worker
+    started = []
+    for worker in idle_workers:
+        consumer_id = get_consumer_id(host, worker)
+        try:
+            tasks = api.get_queue().pop_many(consumer_id, kwargs["prefetch"])
+        except Exception as e:
+            message = "Cannot pop. {}: {}".format(type(e).__name__, str(e))
+            if not started:
+                return error(message)
+            logger.error(message)
+            break
+
+        if not tasks:
+            # Queue is empty or process undergoing
+            break
+
+        task_kwargs = kwargs.copy()
+        task_kwargs.update({
+            "tasks": map(lambda t: (t.task_uid, t.username), tasks),
+            "consumer_id": consumer_id,
+        })
+        name = "{}{}".format(CONSUMER_THREAD_PREFIX, worker)
+        t = threading.Thread(name=name, target=run_worker,
+                             kwargs=task_kwargs)
+        t.daemon = True
+        t.start()
+        started.append(name)
+
+    if not started:
+        return info("Queue is empty or process undergoing [SKIP]")
+
+    return info("Consumers started: {}".format(", ".join(started)))
+
+
+def run_worker(tasks, consumer_id, server_url, user_id, auth_key,
+               http_pool_size=None, http_max_retries=None, prefetch=1,
+               max_idle=MAX_IDLE, **kwargs):
+    """Processes the tasks passed-in, as tuples of (task_uid, task_username),
+    one after the other and acknowledges them all at once. Pulls the next
+    tasks from the queue as soon as the previous ones are done, until the
+    queue is empty for longer than max_idle seconds. Waits with an exponential
+    backoff between consecutive pulls while the queue is empty
+    """
+    settings = {
+        "consumer_id": consumer_id,
+        "server_url": server_url,
+        "user_id": user_id,
+        "auth_key": auth_key,
+        "http_pool_size": http_pool_size,
+        "http_max_retries": http_max_retries,
+    }
+    kwargs.update(settings)
+
+    idle = 0
+    backoff = MIN_BACKOFF
+    while True:
+        if tasks:
+            # Keep the lease of the tasks while processing
+            stop = threading.Event()
+            beat = threading.Thread(target=send_heartbeats, args=(stop, ),
+                                    kwargs=settings)
+            beat.daemon = True
+            beat.start()
+            try:
+                outcomes = map(lambda t: process_task(*t, **kwargs), tasks)
+                outcomes = zip(map(lambda t: t[0], tasks), outcomes)
+                ack_tasks(outcomes, **settings)
+            finally:
+                stop.set()
+            idle = 0
+            backoff = MIN_BACKOFF
+
+        elif idle >= max_idle:
+            return info("Queue is empty, worker stopped: {}".format(
+                consumer_id))
+
+        else:
+            # Queue is empty, wait a bit longer each time
+            time.sleep(backoff)
+            idle += backoff
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+        tasks = pop_tasks(prefetch, **settings)
+
+
+def pop_tasks(max_tasks, consumer_id, server_url, user_id, auth_key,
+              http_pool_size=None, http_max_retries=None):
+    """Pops up to max_tasks tasks for the consumer passed-in via POST against
+    the queue server
+    :return: list of tuples (task_uid, task_username). The list is empty if
+        the queue is empty or the queue server cannot be reached
+    """
+    session = get_session(http_pool_size, http_max_retries)
+    data = {
+        "consumer_id": consumer_id,
+        "max_tasks": max_tasks,
+        "__zeo": consumer_id,
+    }
+    try:
+        response = post(session, user_id, auth_key, server_url,
+                        "queue_server/pop_many", data, timeout=10)
+        items = response.json().get("items") or []
+    except Exception as e:
+        message = "{}: {}".format(type(e).__name__, str(e))
+        logger.error("Cannot pop tasks. {}".format(message))
+        return []
+    return map(lambda t: (t.get("task_uid"), t.get("username")), items)
 
 
-def process_task(task_uid, task_username, consumer_id, base_url, server_url,
-                 user_id, max_seconds, auth_key):
-    """Processes the task passed in gracefully
+def send_heartbeats(stop, consumer_id, server_url, user_id, auth_key,
+                    http_pool_size=None, http_max_retries=None,
+                    interval=HEARTBEAT_INTERVAL):
+    """Renews the lease of the tasks the consumer is processing via POST
+    against the queue server periodically, until the stop event is set
+    :param stop: threading.Event to set when the consumer is done
+    """
+    session = get_session(http_pool_size, http_max_retries)
+    data = {
+        "consumer_id": consumer_id,
+        "__zeo": consumer_id,
+    }
+    while not stop.wait(interval):
+        try:
+            post(session, user_id, auth_key, server_url,
+                 "queue_server/heartbeat", data, timeout=5)
+        except Exception as e:
+            # Lease is kept as long as next heartbeat reaches the server
+            message = "{}: {}".format(type(e).__name__, str(e))
+            logger.warn("Heartbeat not sent. {}".format(message))
+
+
+def ack_tasks(outcomes, consumer_id, server_url, user_id, auth_key,
+              http_pool_size=None, http_max_retries=None,
+              max_attempts=ACK_MAX_ATTEMPTS):
+    """Notifies the queue server about the outcome of the tasks processed by
+    the consumer, all at once. Retries with an exponential backoff while the
+    queue server cannot be reached or fails with a server error. The queue
+    server skips the tasks that are not running, so a notification that is
+    sent twice has no effect
+    :param outcomes: list of tuples (task_uid, (outcome, error message,
+        conflicts)), with outcome being either "done", "fail" or "timeout" and
+        conflicts the number of conflict errors while processing the task
+    :param max_attempts: max number of attempts to notify the queue server
+    :return: the message of the error, if any
     """
-    def post(username, site_url, endpoint, payload, timeout):
-        url = "{}/@@API/senaite/v1/{}".format(site_url, endpoint)
+    def get_uids(outcome):
+        items = filter(lambda o: o[1][0] == outcome, outcomes)
+        return map(lambda o: o[0], items)
 
-        # POST authenticated with the username
-        auth = QueueAuth(username, auth_key)
-        payload = payload or {}
-        response = requests.post(url, json=payload, auth=auth, timeout=timeout)
+    failed = filter(lambda o: o[1][0] == "fail", outcomes)
+    data = {
+        "done": get_uids("done"),
+        "failed": dict(map(lambda o: (o[0], o[1][1]), failed)),
+        "timeout": get_uids("timeout"),
+        "conflicts": dict(filter(lambda c: c[1], map(
+            lambda o: (o[0], o[1][2]), outcomes))),
+        "consumer_id": consumer_id,
+        "__zeo": consumer_id,
+    }
+    backoff = MIN_BACKOFF
+    for attempt in range(1, max_attempts + 1):
+        try:
+            # POST to the ack endpoint from the Queue's server, authenticated
+            # as the user who initiated the consumer
+            session = get_session(http_pool_size, http_max_retries)
+            post(session, user_id, auth_key, server_url, "queue_server/ack",
+                 data, timeout=10)
+            return None
+        except Exception as e:
+            message = "{}: {}".format(type(e).__name__, str(e))
+            if attempt >= max_attempts or not is_transient(e):
+                logger.error("Cannot acknowledge tasks. {}".format(message))
+                return message
+
+            logger.warn("Cannot acknowledge tasks, retrying in {}s. {}"
+                        .format(backoff, message))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
 
-        # Check if success
-        if not response.ok:
-            try:
-                resp = response.json()
-                success = resp.get("success", True)
-                err_msg = resp.get("message", None)
-            except ValueError:
-                # Fallback to request's default error handling
-                response.raise_for_status()
-                return
-
-            # Extract the message coming from senaite's instance
-            if not success and err_msg:
-                err_msg = u'{} {}'.format(response.status_code, err_msg)
-                raise HTTPError(err_msg, response=response)
 
+def is_transient(exception):
+    """Returns whether the exception passed-in is raised because the queue
+    server cannot be reached or fails temporarily, so the request can be sent
+    again later
+    """
+    if isinstance(exception, HTTPError):
+        response = exception.response
+        status = response is not None and response.status_code or 500
+        return status >= 500
+    return isinstance(exception, RequestException)
+
+
+def post(session, username, auth_key, site_url, endpoint, payload, timeout):
+    """Sends a POST against the endpoint of the site passed-in, authenticated
+    with the username passed-in. Raises an exception if the response status
+    is not HTTP 2xx or timeout
+    :return: the response
+    """
+    url = "{}/@@API/senaite/v1/{}".format(site_url, endpoint)
+
+    # POST authenticated with the username
+    auth = QueueAuth(username, auth_key)
+    payload = payload or {}
+    response = session.post(url, json=payload, auth=auth, timeout=timeout)
+
+    # Check if success
+    if not response.ok:
+        try:
+            resp = response.json()
+            success = resp.get("success", True)
+            err_msg = resp.get("message", None)
+        except ValueError:
             # Fallback to request's default error handling
             response.raise_for_status()
+            return response
+
+        # Extract the message coming from senaite's instance
+        if not success and err_msg:
+            err_msg = u'{} {}'.format(response.status_code, err_msg)
+            raise HTTPError(err_msg, response=response)
+
+        # Fallback to request's default error handling
+        response.raise_for_status()
+
+    return response
+
+
+def process_task(task_uid, task_username, consumer_id, base_url, max_seconds,
+                 auth_key, http_pool_size=None, http_max_retries=None,
+                 db=None, site_path=None, **kwargs):
+    """Processes the task passed in gracefully. If both the database and the
+    physical path of the site are passed in, the task is processed within the
+    current thread. The task is processed via POST against this same consumer
+    otherwise, or if the task cannot be processed within the current thread.
+    Conflict errors are retried within the thread before the task is reported
+    as failed. Tasks that are not processed within max_seconds are reported
+    as timed out, and their changes are not committed
+    :return: tuple (outcome, error message, conflicts), with outcome being
+        either "done", "fail" or "timeout" and conflicts the number of
+        conflict errors while processing the task
+    """
+    # Keep-alive connections shared with other threads of this zeo client
+    session = get_session(http_pool_size, http_max_retries)
 
     data = {
         "task_uid": task_uid,
         "consumer_id": consumer_id,
         "__zeo": consumer_id
     }
+    conflicts = []
     try:
-        # POST to the 'process' endpoint from the Queue's consumer,
-        # authenticated as the user who added the task
-        post(task_username, base_url, "queue_consumer/process", data,
-             timeout=max_seconds)
+        processed = False
+        if db and site_path:
+            # Process the task within this zeo client, authenticated as the
+            # user who added the task
+            processed = execute_with_timeout(
+                max_seconds, db, task_uid, task_username, site_path, base_url,
+                on_conflict=conflicts.append)
+        if not processed:
+            # POST to the 'process' endpoint from the Queue's consumer,
+            # authenticated as the user who added the task
+            post(session, task_username, auth_key, base_url,
+                 "queue_consumer/process", data, timeout=max_seconds)
     except Exception as e:
         # Handle the failed task gracefully
         message = "{}: {}".format(type(e).__name__, str(e))
-        print(message)
+        logger.error("Task {} failed. {}".format(task_uid, message))
+        timeout = isinstance(e, (Timeout, TaskTimeout))
+        outcome = timeout and "timeout" or "fail"
+        return outcome, message, len(conflicts)
+
+    # Task succeeded
+    return "done", None, len(conflicts)
+
 
-        endpoint = isinstance(e, Timeout) and "timeout" or "fail"
-        err_url = "queue_server/{}".format(endpoint)
+def execute_with_timeout(timeout, *args, **kwargs):
+    """Processes the task within a separate thread with `execute_task` and
+    waits up to timeout seconds for the task to finish. Raises TaskTimeout if
+    the task does not finish in time. Threads cannot be stopped, so the thread
+    keeps running in background until the task finishes, but its changes are
+    not committed. Waits for the task to finish if its changes were being
+    committed already when the timeout expired
+    :return: the result of `execute_task`
+    """
+    lock = threading.Lock()
+    state = {}
+
+    def can_commit():
+        with lock:
+            if state.get("expired"):
+                return False
+            state["committing"] = True
+            return True
 
+    def target():
         try:
-            # POST to the fail/timeout endpoint from the Queue's server,
-            # authenticated as the user who initiated the consumer
-            data.update({"error_message": message})
-            post(user_id, server_url, err_url, data, timeout=5)
+            state["result"] = execute_task(*args, can_commit=can_commit,
+                                           **kwargs)
         except Exception as e:
-            message = "{}: {}".format(type(e).__name__, str(e))
-            print(message)
-        finally:
-            return message
+            state["error"] = e
 
-    # Task succeeded
-    try:
-        # POST to the done endpoint from the Queue's server, authenticated
-        # as the user who initiated the consumer
-        post(user_id, server_url, "queue_server/done", data, timeout=10)
-    except Exception as e:
-        message = "{}: {}".format(type(e).__name__, str(e))
-        print(message)
-        return message
+    current = threading.current_thread().getName()
+    name = "{}{}".format(EXECUTOR_THREAD_PREFIX, current)
+    thread = threading.Thread(name=name, target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+
+    with lock:
+        if thread.is_alive() and not state.get("committing"):
+            state["expired"] = True
+            raise TaskTimeout("Not processed in {}s".format(timeout))
 
-    return "Task processed: {}".format(consumer_id)
+    # Changes are being committed, wait for the task to finish
+    thread.join()
+    if "error" in state:
+        raise state["error"]
+    return state.get("result")
 
 
-def get_consumer_thread():
-    """Returns whether there the consumer thread is running
+def get_consumer_threads():
+    """Returns the consumer threads that are running
     """
     def is_consumer_thread(t):
         return t.getName().startswith(CONSUMER_THREAD_PREFIX)
 
-    threads = filter(is_consumer_thread, threading.enumerate())
-    if len(threads) > 0:
-        return threads[0]
-    return None
+    return filter(is_consumer_thread, threading.enumerate())
+
+
+def get_idle_workers(workers):
+    """Returns the numbers of the workers, from 1 up to the number of workers
+    passed-in, that are not processing any task
+    """
+    names = map(lambda t: t.getName(), get_consumer_threads())
+    busy = map(lambda name: name[len(CONSUMER_THREAD_PREFIX):], names)
+    return filter(lambda num: str(num) not in busy, range(1, workers + 1))
 
 
 def msg(message, mode="info"):
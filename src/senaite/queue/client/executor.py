@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import random
+import time
+import traceback
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from plone.browserlayer.utils import registered_layers
+from senaite.queue import api
+from senaite.queue import logger
+from senaite.queue.interfaces import IQueuedTaskAdapter
+from senaite.queue.request import fail as _fail
+from six.moves.urllib import parse
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from zope.component import queryAdapter
+from zope.component.hooks import setSite
+from zope.globalrequest import setRequest
+from zope.interface import alsoProvides
+
+from bika.lims import api as capi
+from bika.lims.interfaces import IWorksheet
+
+# Number of times the processing of a task is retried on conflict errors, as
+# ZPublisher does with requests
+MAX_CONFLICT_RETRIES = 3
+
+# Max seconds to wait before the first retry on a conflict error. The wait is
+# doubled on each retry and randomized, so threads that conflicted with each
+# other do not retry at the same time again
+CONFLICT_BACKOFF = 0.1
+
+
+class TaskTimeout(Exception):
+    """Raised when a task is not processed within the max number of seconds
+    """
+
+
+def get_task(task_uid):
+    """Resolves the task for the given task uid
+    """
+    if not capi.is_uid(task_uid) or task_uid == "0":
+        # 400 Bad Request, wrong task uid
+        _fail(412, "Task uid empty or no valid format")
+
+    task = api.get_queue().get_task(task_uid)
+    if not task:
+        _fail(404, "Task {}".format(task_uid))
+
+    if not capi.is_uid(task.context_uid):
+        _fail(500, "Task's context uid is not valid")
+
+    return task
+
+
+def run_task(task, request):
+    """Processes the task passed-in with the IQueuedTaskAdapter registered for
+    the context of the task, within the current request and security context
+    :param task: the QueueTask to process
+    :param request: the current request
+    """
+    task_context = task.get_context()
+    if not task_context:
+        _fail(500, "Task's context is not available")
+
+    # Get the adapter able to process this specific type of task
+    adapter = queryAdapter(task_context, IQueuedTaskAdapter, name=task.name)
+    if not adapter:
+        _fail(501, "No adapter found for {}".format(task.name))
+
+    logger.info("Processing task {}: '{}' for '{}' ({}) ...".format(
+        task.task_short_uid, task.name, capi.get_id(task_context),
+        task.context_uid))
+
+    # Inject the queue_consumer marker to the request so guards skip checks
+    # against the queue
+    request.set("queue_tuid", task.task_uid)
+
+    # If the task refers to a worksheet, inject (ws_id) in params to make
+    # sure guards (assign, un-assign) return True
+    if IWorksheet.providedBy(task_context):
+        request.set("ws_uid", capi.get_uid(task_context))
+
+    # Process the task
+    adapter.process(task)
+
+
+def execute_task(db, task_uid, task_username, site_path, base_url,
+                 on_conflict=None, can_commit=None):
+    """Processes the task with the given uid within the current thread, with
+    its own connection to the database and authenticated as the user the task
+    belongs to, without the need of sending a request to the consumer. The
+    transaction is committed afterwards and retried on conflict errors
+    :param db: the database to open the connection to
+    :param task_uid: uid of the task to process
+    :param task_username: id of the user the task belongs to
+    :param site_path: physical path of the site
+    :param base_url: url of the site
+    :param on_conflict: function called with the error on each conflict
+    :param can_commit: function called before the transaction is committed.
+        If returns False (e.g. the task timed out), the transaction is aborted
+        and TaskTimeout is raised
+    :return: True if the task has been processed or False if the task cannot
+        be processed within the current thread (e.g. user not found)
+    """
+    try:
+        connection = db.open()
+        root = connection.root()["Application"]
+    except Exception:
+        logger.warn("Cannot open a connection to the database:\n{}".format(
+            traceback.format_exc()))
+        return False
+
+    try:
+        retries = MAX_CONFLICT_RETRIES
+        while True:
+            transaction.begin()
+            try:
+                # Wrap the root with a new request on each attempt, because
+                # the request might have been modified on previous attempt
+                app = makerequest(root, environ=get_environ(base_url))
+                site = app.unrestrictedTraverse(site_path, None)
+                if site is None:
+                    logger.warn("Site not found: {}".format(site_path))
+                    return False
+
+                user = get_user(site, task_username)
+                if user is None:
+                    logger.warn("User not found: {}".format(task_username))
+                    return False
+
+                request = setup_request(app, site)
+                newSecurityManager(request, user)
+
+                task = get_task(task_uid)
+                if task.username != task_username:
+                    # Authenticated, but user does not have access to the task
+                    _fail(403)
+
+                run_task(task, request)
+                if can_commit and not can_commit():
+                    # The task has been reported as timed out already
+                    raise TaskTimeout("Task {} not processed in time"
+                                      .format(task_uid))
+                transaction.commit()
+                return True
+
+            except ConflictError as e:
+                transaction.abort()
+                if on_conflict:
+                    on_conflict(e)
+                if retries <= 0:
+                    raise
+                retries -= 1
+                wait = get_conflict_backoff(MAX_CONFLICT_RETRIES - retries)
+                logger.info("Conflict while processing task {}, retrying in "
+                            "{:.2f}s".format(task_uid, wait))
+                time.sleep(wait)
+    finally:
+        transaction.abort()
+        noSecurityManager()
+        setRequest(None)
+        setSite(None)
+        connection.close()
+
+
+def get_conflict_backoff(attempt):
+    """Returns the seconds to wait before the attempt passed-in is retried
+    because of a conflict error, with full jitter
+    """
+    return random.uniform(0, CONFLICT_BACKOFF * 2 ** (attempt - 1))
+
+
+def get_environ(base_url):
+    """Returns the environment of the request to process tasks with, so urls
+    are generated for the url of the site passed-in
+    """
+    url = parse.urlparse(base_url)
+    https = url.scheme == "https"
+    environ = {
+        "SERVER_NAME": url.hostname,
+        "SERVER_PORT": str(url.port or (https and 443 or 80)),
+        "REQUEST_METHOD": "POST",
+    }
+    if https:
+        environ["HTTPS"] = "on"
+    return environ
+
+
+def get_user(site, username):
+    """Returns the user with the given username, wrapped in the acl_users it
+    belongs to. Looks for the user in the site first and then in the root
+    """
+    for context in [site, site.getPhysicalRoot()]:
+        acl_users = context.acl_users
+        user = acl_users.getUserById(username)
+        if user is not None:
+            return user.__of__(acl_users)
+    return None
+
+
+def setup_request(app, site):
+    """Sets up the request of the app passed-in as it would be when traversing
+    to the site passed-in, and sets both as the current request and site
+    """
+    request = app.REQUEST
+    request["PARENTS"] = [site, app]
+    setRequest(request)
+    setSite(site)
+
+    # Apply the browser layers of the add-ons installed and the skin
+    layers = registered_layers()
+    if layers:
+        alsoProvides(request, *layers)
+    site.setupCurrentSkin(request)
+    return request
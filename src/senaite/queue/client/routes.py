@@ -18,27 +18,24 @@
 # Copyright 2019-2021 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import time
 from senaite.jsonapi import request as req
 from senaite.jsonapi.v1 import add_route
-from senaite.queue import api
-from senaite.queue import logger
 from senaite.queue.client import consumer
-from senaite.queue.interfaces import IQueuedTaskAdapter
+from senaite.queue.client.executor import get_task
+from senaite.queue.client.executor import run_task
 from senaite.queue.request import fail as _fail
 from senaite.queue.request import get_message_summary
 from senaite.queue.request import handle_queue_errors
-from zope.component import queryAdapter
 
 from bika.lims import api as capi
-from bika.lims.interfaces import IWorksheet
 
 
 @add_route("/queue_consumer/consume",
            "senaite.queue.consumer.consume", methods=["GET", "POST"])
 @handle_queue_errors
 def consume(context, request):  # noqa
-    """Endpoint to handle the consumption of a queued task, if any
+    """Endpoint to start the consumer workers that are not running, if there
+    are queued tasks. Running workers pull the tasks on their own
     """
     # disable CSRF
     req.disable_csrf_protection()
@@ -68,56 +65,9 @@ def process(context, request, task_uid=None):  # noqa
         # 403 Authenticated, but user does not have access to the resource
         _fail(403)
 
-    # Process
-    t0 = time.time()
-    task_context = task.get_context()
-    if not task_context:
-        _fail(500, "Task's context is not available")
-
-    # Get the adapter able to process this specific type of task
-    adapter = queryAdapter(task_context, IQueuedTaskAdapter, name=task.name)
-    if not adapter:
-        _fail(501, "No adapter found for {}".format(task.name))
-
-    logger.info("Processing task {}: '{}' for '{}' ({}) ...".format(
-        task.task_short_uid, task.name, capi.get_id(task_context),
-        task.context_uid))
-
-    # Inject the queue_consumer marker to the request so guards skip checks
-    # against the queue
-    request = capi.get_request()
-    request.set("queue_tuid", task_uid)
-
-    # If the task refers to a worksheet, inject (ws_id) in params to make
-    # sure guards (assign, un-assign) return True
-    if IWorksheet.providedBy(task_context):
-        request.set("ws_uid", capi.get_uid(task_context))
-
     # Process the task
-    adapter.process(task)
-
-    # Sleep a bit for minimum effect against userland threads
-    # Better to have a transaction conflict here than in userland
-    min_seconds = task.get("min_seconds", 3)
-    while time.time() - t0 < min_seconds:
-        time.sleep(0.5)
+    run_task(task, capi.get_request())
 
     msg = "Processed: {}".format(task.task_short_uid)
     return get_message_summary(msg, "consumer.process")
 
-
-def get_task(task_uid):
-    """Resolves the task for the given task uid
-    """
-    if not capi.is_uid(task_uid) or task_uid == "0":
-        # 400 Bad Request, wrong task uid
-        _fail(412, "Task uid empty or no valid format")
-
-    task = api.get_queue().get_task(task_uid)
-    if not task:
-        _fail(404, "Task {}".format(task_uid))
-
-    if not capi.is_uid(task.context_uid):
-        _fail(500, "Task's context uid is not valid")
-
-    return task
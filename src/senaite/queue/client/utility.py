@@ -21,7 +21,7 @@
 import copy
 
 import math
-import requests
+import threading
 import time
 from requests.exceptions import ConnectionError
 from requests.exceptions import HTTPError
@@ -30,24 +30,42 @@ from requests.exceptions import TooManyRedirects
 from senaite.jsonapi.exceptions import APIError
 from senaite.queue import api
 from senaite.queue import logger
+from senaite.queue.datamanager import discard_pending_tasks
+from senaite.queue.datamanager import get_data_manager
+from senaite.queue.datamanager import get_pending_tasks
 from senaite.queue.interfaces import IClientQueueUtility
 from senaite.queue.pasplugin import QueueAuth
 from senaite.queue.queue import get_task_uid
+from senaite.queue.queue import get_tasks_page
 from senaite.queue.queue import is_task
 from senaite.queue.queue import to_task
+from senaite.queue.session import get_max_retries
+from senaite.queue.session import get_pool_size
+from senaite.queue.session import get_session
 from zope.interface import implements  # noqa
 
 from bika.lims import api as capi
 
+# Name of the thread that keeps the local pool up-to-date with the server
+LISTENER_THREAD_NAME = "senaite.queue.client.listener"
+
+# Settings the listener is restarted on change. Other settings (e.g. the user
+# or the zeo client of the current request) do not change its behavior
+LISTENER_KEYS = ("server_url", "auth_key")
+
 
 class ClientQueueUtility(object):
     implements(IClientQueueUtility)
 
-    # The HTTP requests handler
-    _req = requests
+    # The HTTP requests handler. If None, the HTTP session shared by all the
+    # threads of this zeo client is used
+    _req = None
 
-    # Local store of tasks that is kept up-to-date with queue server
+    # Local store of tasks that is kept up-to-date with queue server. The list
+    # is never modified in place, but replaced while holding the lock, so it
+    # can be safely read from any thread without locking
     _tasks = []
+    _lock = threading.Lock()
 
     # Synchronization frequency with the queue server in seconds
     # This is used to keep the local store of tasks up-to-date
@@ -60,14 +78,173 @@ class ClientQueueUtility(object):
     # Last synchronization time millis
     _last_sync = None
 
+    # Last time the local pool was successfully synchronized with the server
+    _last_synced = None
+
+    # Epoch and version of the server's queue the local pool is in sync with
+    _epoch = None
+    _version = None
+
+    # Seconds between full synchronizations with the queue server, so the
+    # tasks the server does not know about (e.g. not added because a task for
+    # same context and name was queued in the meantime) are eventually removed
+    # from the local pool
+    _full_sync_frequency = 300
+
+    # Last time the local pool was fully synchronized with the server
+    _last_full_sync = None
+
+    # Number of times the local pool of tasks has been changed
+    _revision = 0
+
+    # Maximum seconds the queue server holds a request for changes before
+    # responding (long-polling). Set to 0 for regular polling
+    _long_poll_wait = 20
+
+    # Background thread that keeps the local pool up-to-date, the values of
+    # the settings it was started with (see LISTENER_KEYS) and the lock that
+    # guards its start
+    _listener = None
+    _listener_key = None
+    _listener_lock = threading.Lock()
+
+    # Seconds between checks of the settings the listener was started with,
+    # so the registry is not read each time the queue utility is requested
+    _listener_check_frequency = 10
+
+    # Last time the settings of the listener were checked
+    _listener_checked = None
+
     def is_out_of_date(self):
         """Returns whether this client queue utility is out-of-date and requires
         a synchronization of tasks with the queue server
         :return: True if this utility is out-of-date
         """
-        if self._last_sync is None:
+        staleness = self.get_staleness()
+        if staleness is None:
             return True
-        return self._last_sync + self._sync_frequency < time.time()
+        # The server responds at least once per long-poll wait
+        return staleness > self._long_poll_wait + self._sync_frequency
+
+    def get_staleness(self):
+        """Returns the number of seconds elapsed since the local pool of tasks
+        was successfully synchronized with the queue server for the last time.
+        The server responds as soon as there are changes, or when long-poll
+        wait expires otherwise, so a value above the long-poll wait means the
+        local pool might not be up-to-date
+        :return: seconds since last synchronization or None if never synced
+        :rtype: float
+        """
+        last_synced = self._last_synced
+        if last_synced is None:
+            return None
+        return max(time.time() - last_synced, 0)
+
+    def is_listening(self):
+        """Returns whether the background thread that keeps the local pool of
+        tasks up-to-date with the queue server is running
+        """
+        listener = self._listener
+        return listener is not None and listener.is_alive()
+
+    def listen(self):
+        """Starts a background thread that keeps the local pool of tasks
+        up-to-date with the queue server by long-polling for changes, so there
+        is no need to synchronize the pool while handling user requests. The
+        thread sends the requests on behalf of the user that started it. Does
+        nothing if the listener is running already with same server url and
+        auth key. If the local pool was never synchronized (e.g. the zeo client
+        has just been started), the pool is synchronized right away, without
+        waiting for the listener
+        """
+        # Do not read the settings on every call, but from time to time
+        checked = self._listener_checked or 0
+        recently = time.time() - checked < self._listener_check_frequency
+        if recently and self._last_synced and self.is_listening():
+            return
+
+        settings = self._get_settings()
+        if not all([settings["server_url"], settings["username"]]):
+            return
+
+        # Start the listener, unless running with same settings already
+        self._start_listener(settings)
+
+        if self._last_synced is None:
+            # Do not wait for the listener. Queued objects would be considered
+            # as not queued until its first pull finishes otherwise
+            self._sync_first(settings)
+
+    def _start_listener(self, settings):
+        """Starts the background thread that keeps the local pool of tasks
+        up-to-date, unless is running already with same server url and auth key
+        """
+        self._listener_checked = time.time()
+        key = tuple(map(lambda k: settings[k], LISTENER_KEYS))
+        if self.is_listening() and key == self._listener_key:
+            return
+
+        with self._listener_lock:
+            # Another request might have started the listener in the meantime
+            if self.is_listening() and key == self._listener_key:
+                return
+
+            # Settings (e.g. the queue server url) changed, stop current one
+            self._listener_key = key
+            listener = threading.Thread(name=LISTENER_THREAD_NAME,
+                                        target=self._listen,
+                                        args=(settings, key))
+            listener.daemon = True
+            self._listener = listener
+            listener.start()
+
+    def _sync_first(self, settings):
+        """Pulls the tasks from the queue server while the local pool has never
+        been synchronized. Does nothing if the last attempt was too recent
+        (e.g. the queue server is not reachable)
+        """
+        last_sync = self._last_sync or 0
+        if time.time() - last_sync < self._sync_frequency:
+            return
+        try:
+            self._sync_pull(settings=settings)
+        except Exception as e:
+            logger.error("{}: {}".format(type(e).__name__, str(e)))
+            self._last_sync = time.time()
+            set_response_ok()
+
+    def _listen(self, settings, key):
+        """Pulls the changes from the queue server, that holds each request
+        until there are changes or the long-poll wait expires, and pushes the
+        tasks handled offline. Keeps running until the server url or the auth
+        key change
+        """
+        logger.info("Queue listener started: {}".format(settings["server_url"]))
+        while key == self._listener_key:
+            version = self._version
+            started = time.time()
+            try:
+                synced = self._sync_pull(wait=self._long_poll_wait,
+                                         settings=settings)
+                if synced:
+                    self._sync_push(settings=settings)
+            except Exception as e:
+                logger.error("{}: {}".format(type(e).__name__, str(e)))
+                synced = False
+
+            if synced and self._version != version:
+                # Ask for the next changes right away
+                continue
+
+            if synced and time.time() - started >= self._long_poll_wait:
+                # The server waited for changes, but there were none
+                continue
+
+            # The server is not reachable or cannot wait for changes (e.g.
+            # too many clients waiting already). Fall back to polling
+            time.sleep(self._sync_frequency)
+
+        logger.info("Queue listener stopped: {}".format(settings["server_url"]))
 
     # TODO Add a synchronize decorator here?
     def sync(self):
@@ -96,6 +273,9 @@ class ClientQueueUtility(object):
         considered in order to not bother users unnecessarily. Each zeo client
         has it's own local pool of tasks and this synchronization does not do
         any kind of sync among them.
+
+        Zeo clients do this synchronization in a background thread (see
+        `listen`), so user requests never wait for the queue server.
         """
         # Download new tasks from server
         self._sync_pull()
@@ -103,22 +283,32 @@ class ClientQueueUtility(object):
         # Push tasks that have been handled offline
         self._sync_push()
 
-    def _sync_pull(self):
+    def _sync_pull(self, wait=0, settings=None):
         """Updates the local tasks with those from the queue server
+        :param wait: (Optional) seconds the server can wait for changes
+        :param settings: (Optional) settings to use for the requests to the
+            queue server. If None, settings are taken from current request
         """
-        # Tell the server the task uids we have in our local pool, but those
-        # with status running (always pull running tasks)
-        queued = filter(lambda t: t.status == "queued", self._tasks)
+        # Tell the server the version of the queue we are in sync with, so
+        # only the changes since then are retrieved. Ask for all the tasks
+        # from time to time, so the tasks the server does not know about are
+        # removed from the local pool
+        known = (self._epoch, self._version)
+        last_full_sync = self._last_full_sync or 0
+        full_sync = time.time() - last_full_sync > self._full_sync_frequency
         query = {
-            "uids": map(lambda t: t.task_uid, queued),
+            "epoch": self._epoch,
+            "version": None if full_sync else self._version,
             "status": ["queued", "running"],
             "complete": True,
+            "wait": wait,
         }
 
         err = None
         data = None
         try:
-            data = self._post("diff", payload=query)
+            data = self._post("changes", payload=query, timeout=10 + wait,
+                              settings=settings)
         except (ConnectionError, Timeout, TooManyRedirects) as e:
             err = "{}: {}".format(type(e).__name__, str(e))
 
@@ -142,68 +332,102 @@ class ClientQueueUtility(object):
             self._sync_frequency = min([self._sync_frequency_max,
                                         self._sync_frequency])
             self._last_sync = time.time()
-            capi.get_request().response.setStatus(200)
+            set_response_ok()
             return False
 
         # Restore sync_frequency
         self._sync_frequency = 2
 
-        # Get the stale task uids from the response
-        stale = filter(None, data.get("stale", []))
+        # Get the task uids removed from the server since last sync
+        removed = set(filter(None, data.get("removed", [])))
 
-        # Get the new tasks retrieved from the server
+        # Get the new or changed tasks retrieved from the server
         new_tasks = filter(None, map(to_task, data.get("items", [])))
+        new_tasks = map(lambda t: t.freeze(), new_tasks)
+        new_uids = set(map(lambda t: t.task_uid, new_tasks))
+
+        # Whether the server sent all tasks instead of the changes only
+        resync = data.get("resync", True)
 
         def keep(task):
-            if task.task_uid in stale:
-                # This task is no longer valid
-                return False
+            if task.get("offline"):
+                # Tasks handled offline have priority over server's
+                return True
 
-            if task in new_tasks:
-                # Server's task has priority over local's unless the local
-                # task is labeled with "offline" wildcard
-                if task.get("offline"):
-                    return True
+            if task.task_uid in removed or task.task_uid in new_uids:
+                # This task is no longer valid or there is a newer version
                 return False
 
-            if task.status in "running":
-                # Always drop running tasks
-                return False
+            # In sync, unless the server sent all tasks
+            return not resync
 
-            # In sync or unknown by server
-            return True
+        with self._lock:
+            if (self._epoch, self._version) != known:
+                # Another thread synchronized the pool in the meantime. These
+                # changes are stale, the next pull will retrieve the rest
+                return True
+
+            # Drop the tasks from server that are labeled as offline locally
+            offline = filter(lambda t: t.get("offline"), self._tasks)
+            offline = set(map(lambda t: t.task_uid, offline))
+            new_tasks = filter(lambda t: t.task_uid not in offline, new_tasks)
 
-        # Keep unknowns and remove stales or more recent tasks
-        self._tasks = filter(keep, self._tasks)
+            # Keep unknowns and remove stales or more recent tasks
+            tasks = filter(keep, self._tasks)
 
-        # Extend with the new tasks retrieved from the server
-        self._tasks.extend(new_tasks)
+            # Extend with the new tasks retrieved from the server
+            tasks.extend(new_tasks)
+            self._set_tasks(tasks)
 
-        # Sort by priority + created
-        self._tasks.sort(key=lambda t: (t.created + (300 * t.priority)))
+            # Update the version of the server's queue we are in sync with
+            self._epoch = data.get("epoch")
+            self._version = data.get("version")
+            if resync:
+                self._last_full_sync = time.time()
 
         # Update the last synchronization time
         self._last_sync = time.time()
+        self._last_synced = self._last_sync
         return True
 
-    def _sync_push(self):
+    def _sync_push(self, settings=None):
         """Pushes the tasks modified locally to the queue server
+        :param settings: (Optional) settings to use for the requests to the
+            queue server. If None, settings are taken from current request
         """
         for task in filter(lambda t: t.get("offline"), self._tasks):
             action = task.get("offline")
-            action_func = getattr(self, action)
+            if action == "add":
+                payload = task.to_dict()
+                payload.pop("offline")
+            else:
+                payload = {"task_uid": task.task_uid}
             try:
-                task.pop("offline")
-                action_func(task)
+                response = self._post(action, payload=payload,
+                                      settings=settings)
             except Exception as e:
                 # push is not critical to operate, dismiss
                 err = "{}: {}".format(type(e).__name__, str(e))
                 logger.error(err)
-                capi.get_request().response.setStatus(200)
+                set_response_ok()
+                continue
+
+            accepted = response.get("accepted", [task.task_uid])
+            if action == "done":
+                self._discard([task.task_uid])
+            elif action == "add" and task.task_uid not in accepted:
+                # The queue server did not add the task
+                self._discard([task.task_uid])
+            else:
+                task = task.thaw()
+                task.pop("offline")
+                self._store([task])
 
     def add(self, task):
-        """Adds a task to the queue. It pushes the task directly to the queue
-        server via POST and stores the task in the local pool as well
+        """Adds a task to the queue. The task is pushed to the queue server via
+        POST when the current transaction is committed, together with the rest
+        of tasks added during the transaction, and stored in the local pool as
+        well. The task is discarded if the transaction is aborted
         :param task: the QueueTask to add
         :return: the added QueueTask object
         :rtype: queue.QueueTask
@@ -213,7 +437,7 @@ class ClientQueueUtility(object):
             raise ValueError("{} is not supported".format(repr(task)))
 
         # Don't add to the queue if the task is already in there
-        if task in self._tasks:
+        if task in self._get_pool():
             logger.warn("Task {} ({}) in the queue already"
                         .format(task.name, task.task_short_uid))
             return None
@@ -231,41 +455,65 @@ class ClientQueueUtility(object):
                         task.name, task.context_path))
                 return None
 
-        # Add the task to the queue server
+        # Add the task to the queue server on commit. The task passed-in is
+        # not modified, so frozen tasks (e.g. re-queued ones) can be added too
+        task = task.copy_with(_frozen=True, status="queued")
+        get_data_manager(self._flush).add(task)
+        return task
+
+    def _flush(self, tasks):
+        """Adds the tasks passed-in to the queue server with a single POST and
+        stores the tasks accepted by the server in the local pool. If the
+        queue server is not reachable, tasks are kept in the local pool so they
+        can be synchronized as soon as we have connectivity again. This is
+        called after the transaction is committed, so errors are not raised
+        :param tasks: list of QueueTask objects to add
+        """
         err = None
+        rejected = False
+        accepted = None
         try:
-            self._post("add", payload=task)
+            payload = map(lambda t: t.to_dict(), tasks)
+            response = self._post("add", payload=payload)
+            accepted = response.get("accepted")
         except (ConnectionError, Timeout, TooManyRedirects) as e:
             err = "{}: {}".format(type(e).__name__, str(e))
 
         except HTTPError as e:
             status = e.response.status_code or 500
-            if status < 500 or status >= 600:
-                raise e
+            rejected = status < 500 or status >= 600
             message = e.response.json() or {}
             err = "{}: {}".format(status, message.get("message", str(e)))
 
         except APIError as e:
-            if e.status < 500 or e.status >= 600:
-                raise e
+            rejected = e.status < 500 or e.status >= 600
             err = "{}: {}".format(e.status, e.message)
 
-        if err:
-            # Not able to add the task to the queue server. Keep it locally
-            # so it can be synchronized as soon as we have connectivity again
-            logger.warn(err)
-            capi.get_request().response.setStatus(200)
-            task.update({"offline": "add"})
-
-        # Add the task to our local pool
-        task.update({"status": "queued"})
-        if task not in self._tasks:
-            self._tasks.append(task)
+        if rejected:
+            # The queue server rejected the tasks, do not keep them locally
+            logger.error("Tasks rejected by the queue server: {}".format(err))
+            set_response_ok()
+            return
 
-            # Sort by priority + created
-            self._tasks.sort(key=lambda t: (t.created + (300 * t.priority)))
+        if accepted is not None:
+            # Do not keep the tasks the queue server did not add (e.g. a task
+            # for same context and name was in the queue already)
+            accepted = set(accepted)
+            skipped = filter(lambda t: t.task_uid not in accepted, tasks)
+            for task in skipped:
+                logger.warn("Task {} ({}) not added by the queue server"
+                            .format(task.name, task.task_short_uid))
+            tasks = filter(lambda t: t.task_uid in accepted, tasks)
+
+        elif err:
+            # Not able to add the tasks to the queue server. Keep them locally
+            # so they can be synchronized as soon as we have connectivity again
+            logger.warn(err)
+            set_response_ok()
+            tasks = map(lambda t: t.copy_with(offline="add"), tasks)
 
-        return task
+        # Add the tasks to our local pool
+        self._store(tasks)
 
     def pop(self, consumer_id):
         """Returns the next task to process, if any. Sends a POST to the queue
@@ -277,10 +525,27 @@ class ClientQueueUtility(object):
         payload = {"consumer_id": consumer_id}
         task = self._post("pop", payload=payload)
         task = to_task(task)
-        # Always sync on pop (tasks might be purged by server)
-        self.sync()
+        if task:
+            # Other changes (e.g. purged tasks) are pulled in background
+            self._store([task])
         return task
 
+    def pop_many(self, consumer_id, max_tasks):
+        """Returns up to max_tasks tasks to process, if any. Sends a POST to
+        the queue server and updates the local pool accordingly
+        :param consumer_id: id of the consumer thread that will process the
+            tasks
+        :param max_tasks: max number of tasks to return
+        :return: list of tasks to be processed
+        :rtype: list
+        """
+        payload = {"consumer_id": consumer_id, "max_tasks": max_tasks}
+        response = self._post("pop_many", payload=payload)
+        tasks = filter(None, map(to_task, response.get("items") or []))
+        if tasks:
+            self._store(tasks)
+        return tasks
+
     def done(self, task):
         """Notifies the queue that the task has been processed successfully.
         Sends a POST to the queue server and removes the task from local pool
@@ -311,18 +576,16 @@ class ClientQueueUtility(object):
             # Not able to tell the queue server. Keep it locally so it can be
             # synchronized as soon as we have connectivity again
             logger.warn(err)
-            capi.get_request().response.setStatus(200)
-            task_uid = get_task_uid(task_uid)
-            tasks = filter(lambda t: t.task_uid == task_uid, self._tasks)
+            set_response_ok()
+            tasks = filter(lambda t: t.task_uid == task_uid, self._get_pool())
             if tasks:
                 task = tasks[0]
-            else:
-                self._tasks.append(task)
-            task.update({"offline": "done"})
+            if is_task(task):
+                self._store([task.copy_with(offline="done")])
             return
 
         # Remove from local pool
-        self._tasks = filter(lambda t: t.task_uid != task_uid, self._tasks)
+        self._discard([task_uid])
 
     def fail(self, task, error_message=None):
         """Notifies the queue that the processing of the task failed. Sends a
@@ -332,19 +595,65 @@ class ClientQueueUtility(object):
         """
         task_uid = get_task_uid(task)
         payload = {"task_uid": task_uid, "error_message": error_message or ""}
-        self._post("fail", payload=payload)
-        # Always sync on fail (task might be re-queued or failed by server)
-        self.sync()
+        response = self._post("fail", payload=payload)
+        # Task might be re-queued or failed by server
+        self._update(task_uid, response.get("task"))
 
     def timeout(self, task):
         """Notifies the queue that the processing of the task timed out. Sends a
         POST to the queue server and updates the local pool accordingly
         :param task: task's unique id (task_uid) or QueueTask object
         """
-        payload = {"task_uid": get_task_uid(task)}
-        self._post("timeout", payload=payload)
-        # Always sync on timeout (task might be re-queued or failed by server)
-        self.sync()
+        task_uid = get_task_uid(task)
+        payload = {"task_uid": task_uid}
+        response = self._post("timeout", payload=payload)
+        # Task might be re-queued or failed by server
+        self._update(task_uid, response.get("task"))
+
+    def heartbeat(self, consumer_id):
+        """Renews the lease of the running tasks of the consumer passed-in, so
+        they are not re-queued while the consumer is processing them. Sends a
+        POST to the queue server
+        :param consumer_id: id of the consumer thread that is processing tasks
+        :return: list of the task uids the consumer holds the lease of
+        :rtype: list
+        """
+        payload = {"consumer_id": consumer_id}
+        response = self._post("heartbeat", payload=payload)
+        return response.get("items") or []
+
+    def ack(self, done=None, failed=None, timeout=None, conflicts=None,
+            consumer_id=None):
+        """Notifies the queue about the outcome of the processing of several
+        tasks at once. Sends a POST to the queue server and updates the local
+        pool accordingly
+        :param done: list of task uids processed successfully
+        :param failed: dict of task uids whose processing failed, with the
+            error/traceback as values
+        :param timeout: list of task uids whose processing timed out
+        :param conflicts: dict of task uids with the number of conflict
+            errors the consumer came across while processing them
+        :param consumer_id: (Optional) id of the consumer that processed the
+            tasks. If set, the tasks running for other consumers are skipped
+        :return: list of the task uids acknowledged by the queue
+        :rtype: list
+        """
+        payload = {
+            "done": done or [],
+            "failed": failed or {},
+            "timeout": timeout or [],
+            "conflicts": conflicts or {},
+            "consumer_id": consumer_id,
+        }
+        response = self._post("ack", payload=payload)
+
+        # Tasks done are no longer in the queue
+        self._discard(payload["done"])
+
+        # Tasks failed or timed out might be re-queued or failed by server
+        for task_info in response.get("items") or []:
+            self._update(task_info.get("task_uid"), task_info)
+        return response.get("acked") or []
 
     def delete(self, task):
         """Removes a task from the queue. Sends a POST to the queue server and
@@ -352,6 +661,10 @@ class ClientQueueUtility(object):
         :param task: task's unique id (task_uid) or QueueTask object
         """
         task_uid = get_task_uid(task)
+
+        # The task might not have been sent to the server yet
+        discard_pending_tasks(self._flush, [task_uid])
+
         payload = {"task_uid": task_uid}
         try:
             self._post("delete", payload=payload)
@@ -362,7 +675,99 @@ class ClientQueueUtility(object):
                 raise e
 
         # Remove from our pool
-        self._tasks = filter(lambda t: t.task_uid != task_uid, self._tasks)
+        self._discard([task_uid])
+
+    def requeue(self, task):
+        """Re-queues the task with the max number of retries restored. Sends
+        a POST to the queue server when the current transaction is committed
+        :param task: task's unique id (task_uid) or QueueTask object
+        :return: the task to be re-queued or None if not found
+        :rtype: queue.QueueTask
+        """
+        task = self.get_task(get_task_uid(task))
+        if not task:
+            return None
+        task = task.copy_with(_frozen=True, status="queued")
+        get_data_manager(self._flush_requeue).add(task)
+        return task
+
+    def _flush_requeue(self, tasks):
+        """Re-queues the tasks passed-in in the queue server, one POST per
+        task, and updates the local pool accordingly. This is called after the
+        transaction is committed, so errors are not raised
+        :param tasks: list of QueueTask objects to re-queue
+        """
+        requeued = []
+        for task in tasks:
+            payload = {"task_uid": task.task_uid}
+            try:
+                self._post("requeue", payload=payload)
+                requeued.append(task)
+            except Exception as e:
+                logger.error("Cannot re-queue task {}. {}: {}".format(
+                    task.task_short_uid, type(e).__name__, str(e)))
+                set_response_ok()
+        self._store(requeued)
+
+    def _store(self, tasks):
+        """Stores the tasks passed-in in the local pool, replacing the tasks
+        with same task uid the pool contains, if any
+        """
+        tasks = map(lambda t: t.freeze(), tasks)
+        task_uids = set(map(lambda t: t.task_uid, tasks))
+        with self._lock:
+            pool = filter(lambda t: t.task_uid not in task_uids, self._tasks)
+            self._set_tasks(pool + tasks)
+
+    def _discard(self, task_uids):
+        """Removes the tasks with the task uids passed-in from the local pool
+        """
+        task_uids = set(task_uids)
+        with self._lock:
+            pool = filter(lambda t: t.task_uid not in task_uids, self._tasks)
+            self._set_tasks(pool)
+
+    def _update(self, task_uid, task_info):
+        """Updates the task from the local pool with the task information
+        returned by the queue server, if any. The task is removed from the
+        pool if is no longer queued nor running
+        """
+        task = to_task(task_info)
+        if task and task.status in ["queued", "running"]:
+            self._store([task])
+        elif task:
+            self._discard([task_uid])
+
+    def _get_pool(self):
+        """Returns the tasks from the local pool, along with the tasks added
+        in the current transaction that are pending to be sent to the server
+        """
+        pending = get_pending_tasks(self._flush)
+        if pending:
+            return self._tasks + pending
+        return self._tasks
+
+    def _set_tasks(self, tasks):
+        """Replaces the local pool of tasks by the tasks passed-in, sorted by
+        priority. Must be called while holding the lock
+        """
+        tasks.sort(key=self.get_sort_key)
+        self._tasks = tasks
+        self._revision += 1
+
+    def get_sort_key(self, task):
+        """Returns the key to sort the task passed-in by. Tasks with lower
+        keys have precedence over tasks with higher keys
+        """
+        return task.created + (300 * task.priority)
+
+    def get_revision(self):
+        """Returns a value that changes whenever the local pool of tasks
+        changes, tasks pending to be added in current transaction included.
+        Suitable as a key to cache the results of queries against the queue
+        """
+        pending = get_pending_tasks(self._flush)
+        return self._revision, tuple(map(lambda t: t.task_uid, pending))
 
     def get_task(self, task_uid):
         """Returns the task with the given task uid. Retrieves the task from
@@ -374,7 +779,7 @@ class ClientQueueUtility(object):
         """
         # Search first in our local pool
         task_uid = get_task_uid(task_uid)
-        task = filter(lambda t: t.task_uid == task_uid, self._tasks)
+        task = filter(lambda t: t.task_uid == task_uid, self._get_pool())
         if task:
             return copy.deepcopy(task[0])
 
@@ -418,9 +823,62 @@ class ClientQueueUtility(object):
             return map(to_task, tasks.get("items", []))
 
         # Filter by status
-        tasks = filter(lambda t: t.status in status, self._tasks)
+        tasks = filter(lambda t: t.status in status, self._get_pool())
         return copy.deepcopy(tasks)
 
+    def get_tasks_page(self, status=None, name=None, username=None,
+                       since=None, sort_on=None, sort_order=None, offset=0,
+                       limit=None):
+        """Returns a tuple (tasks, total) with the page of tasks with the
+        given status that match with the criteria passed-in, along with the
+        total number of tasks that match with the criteria. Ghost tasks are
+        only considered when "ghost" is one of the status passed-in
+        :param status: (Optional) a string or list with status. If None, only
+            "running" and "queued" are considered
+        :param name: (Optional) name of the tasks to look for
+        :param username: (Optional) username of the tasks to look for
+        :param since: (Optional) only tasks created after this time
+        :param sort_on: (Optional) attribute to sort the tasks by. Tasks are
+            sorted by their position in the queue by default
+        :param sort_order: (Optional) "ascending" (default) or "descending"
+        :param offset: (Optional) number of tasks to skip
+        :param limit: (Optional) max number of tasks to return
+        :return: tuple (list of QueueTask objects, total number of tasks)
+        """
+        if not isinstance(status, (list, tuple)):
+            status = [status]
+        status = filter(None, status)
+        if not status:
+            status = ["running", "queued"]
+
+        # "ghost" and "failed" statuses require a POST to queue server, cause
+        # we only keep running and queued tasks in our local pool. The server
+        # does the filtering, sorting and pagination
+        ask_server = any(map(lambda s: s in status, ["ghost", "failed"]))
+        if ask_server:
+            query = {
+                "status": status,
+                "complete": True,
+                "name": name,
+                "username": username,
+                "since": since,
+                "sort_on": sort_on,
+                "sort_order": sort_order,
+                "offset": offset,
+                "limit": limit,
+            }
+            data = self._post("tasks", payload=query)
+            tasks = map(to_task, data.get("items", []))
+            return tasks, data.get("total", len(tasks))
+
+        tasks = filter(lambda t: t.status in status, self._get_pool())
+        tasks, total = get_tasks_page(tasks, self.get_sort_key, status=status,
+                                      name=name, username=username,
+                                      since=since, sort_on=sort_on,
+                                      sort_order=sort_order, offset=offset,
+                                      limit=limit)
+        return copy.deepcopy(tasks), total
+
     def get_uids(self, status=None):
         """Returns a list with the uids from the queue
         :param status: (Optional) a string or list with status. If None, only
@@ -428,11 +886,31 @@ class ClientQueueUtility(object):
         :return list of uids
         :rtype: list
         """
-        out = set()
-        for task in self.get_tasks(status=status):
-            uids = [task.context_uid] + filter(None, task.uids)
-            out.update(uids)
-        return list(out)
+        return list(self.iter_uids(status=status))
+
+    def iter_uids(self, status=None):
+        """Returns an iterator over the uids from the queue, without duplicates
+        :param status: (Optional) a string or list with status. If None, only
+            "running" and "queued" are considered
+        """
+        if not isinstance(status, (list, tuple)):
+            status = [status]
+        status = filter(None, status)
+        if not status:
+            status = ["running", "queued"]
+
+        if any(map(lambda s: s in status, ["ghost", "failed"])):
+            # Tasks are fetched from the queue server, not copied
+            tasks = self.get_tasks(status=status)
+        else:
+            tasks = filter(lambda t: t.status in status, self._get_pool())
+
+        seen = set()
+        for task in tasks:
+            for uid in [task.context_uid] + list(filter(None, task.uids)):
+                if uid not in seen:
+                    seen.add(uid)
+                    yield uid
 
     def get_tasks_for(self, context_or_uid, name=None):
         """Returns a list with the queued or running tasks the queue contains
@@ -449,7 +927,7 @@ class ClientQueueUtility(object):
             raise ValueError("{} is not supported".format(repr(context_or_uid)))
 
         tasks = []
-        for task in self._tasks:
+        for task in self._get_pool():
             if name and task.name != name:
                 continue
             if task.context_uid == uid or uid in task.uids:
@@ -478,31 +956,51 @@ class ClientQueueUtility(object):
         :return: True if the queue does not have running nor queued tasks
         :rtype: bool
         """
-        return len(self._tasks) <= 0
+        return len(self._get_pool()) <= 0
+
+    def _get_settings(self):
+        """Returns the settings required to send requests to the queue server
+        on behalf of the current user
+        """
+        request = capi.get_request()
+        return {
+            "server_url": api.get_server_url(),
+            "username": capi.get_current_user().id,
+            "auth_key": capi.get_registry_record("senaite.queue.auth_key"),
+            "zeo": request and request.get("SERVER_URL") or None,
+            "http_pool_size": get_pool_size(),
+            "http_max_retries": get_max_retries(),
+        }
 
-    def _post(self, endpoint, resource=None, payload=None, timeout=10):
+    def _post(self, endpoint, resource=None, payload=None, timeout=10,
+              settings=None):
         """Sends a POST request to SENAITE's Queue Server
         Raises an exception if the response status is not HTTP 2xx or timeout
         :param endpoint: the endpoint to POST against
         :param resource: (Optional) resource from the endpoint to POST against
         :param payload: (Optional) hashable payload for the POST
+        :param settings: (Optional) settings to use for the request. If None,
+            settings are taken from current request
         """
-        server_url = api.get_server_url()
+        settings = settings or self._get_settings()
+        server_url = settings["server_url"]
         parts = "/".join(filter(None, [endpoint, resource]))
         url = "{}/@@API/senaite/v1/queue_server/{}".format(server_url, parts)
         logger.info("** POST: {}".format(url))
 
         # HTTP Queue Authentication to be added in the request
-        auth = QueueAuth(capi.get_current_user().id)
+        auth = QueueAuth(settings["username"], settings["auth_key"])
 
         # Additional information to the payload
-        request = capi.get_request()
         if payload is None:
             payload = {}
-        payload.update({"__zeo": request.get("SERVER_URL")})
+        if isinstance(payload, dict):
+            payload.update({"__zeo": settings["zeo"]})
 
         # This might rise exceptions (e.g. TimeoutException)
-        response = self._req.post(url, json=payload, auth=auth, timeout=timeout)
+        handler = self._req or get_session(settings.get("http_pool_size"),
+                                           settings.get("http_max_retries"))
+        response = handler.post(url, json=payload, auth=auth, timeout=timeout)
 
         # Check the request is successful. Raise exception otherwise
         response.raise_for_status()
@@ -511,4 +1009,14 @@ class ClientQueueUtility(object):
         return response.json()
 
     def __len__(self):
-        return len(self._tasks)
+        return len(self._get_pool())
+
+
+def set_response_ok():
+    """Sets the HTTP status of the current response to 200, if any. Errors
+    handled while communicating with the queue server must not be reported to
+    the user
+    """
+    request = capi.get_request()
+    if request is not None:
+        request.response.setStatus(200)
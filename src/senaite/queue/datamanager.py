@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+import traceback
+
+import transaction
+from senaite.queue import logger
+from transaction.interfaces import ISavepointDataManager
+from zope.interface import implements  # noqa
+
+# Data managers joined to the transaction of the current thread
+_local = threading.local()
+
+
+class QueueDataManager(object):
+    """Transaction data manager that keeps the tasks added to the queue while
+    the transaction is in progress and flushes them all at once after the
+    transaction is committed. Tasks are discarded if the transaction is
+    aborted, so tasks from a transaction that failed never reach the queue
+    """
+    implements(ISavepointDataManager)
+
+    def __init__(self, flush, txn):
+        """
+        :param flush: function that adds the tasks passed-in to the queue
+        :param txn: the transaction this data manager is joined to
+        """
+        self.flush = flush
+        self.transaction = txn
+        self.transaction_manager = transaction.manager
+        self.tasks = []
+
+    def add(self, task):
+        """Adds a task to be flushed on commit
+        """
+        self.tasks.append(task)
+
+    def abort(self, txn):
+        self.tasks = []
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        self.tasks = []
+
+    def sortKey(self):  # noqa camelCase
+        return "~senaite.queue.{}".format(id(self))
+
+    def after_commit(self, status):
+        """Flushes the tasks once the transaction has been committed. Is called
+        when the transaction is no longer the current one, so the tasks can be
+        safely flushed within a new transaction (e.g. via a HTTP request)
+        """
+        tasks, self.tasks = self.tasks, []
+        if not status or not tasks:
+            return
+        try:
+            self.flush(tasks)
+        except Exception:
+            # Data is committed already, flush must not fail at this point
+            logger.error("Cannot flush {} tasks to the queue:\n{}".format(
+                len(tasks), traceback.format_exc()))
+
+    def savepoint(self):
+        return QueueSavepoint(self)
+
+
+class QueueSavepoint(object):
+    """Savepoint of the tasks pending to be flushed by a data manager
+    """
+
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+        self.tasks = list(data_manager.tasks)
+
+    def rollback(self):
+        self.data_manager.tasks = list(self.tasks)
+
+
+def get_data_manager(flush):
+    """Returns the data manager joined to the current transaction that flushes
+    the tasks with the function passed-in. The data manager is created and
+    joined to the transaction if it does not exist yet
+    :param flush: function that adds the tasks passed-in to the queue
+    :rtype: QueueDataManager
+    """
+    txn = transaction.get()
+    data_managers = getattr(_local, "data_managers", None)
+    if data_managers is None or data_managers[0] is not txn:
+        # Data managers from other transactions are no longer valid
+        data_managers = (txn, {})
+        _local.data_managers = data_managers
+
+    data_manager = data_managers[1].get(flush)
+    if data_manager is None:
+        data_manager = QueueDataManager(flush, txn)
+        txn.join(data_manager)
+        txn.addAfterCommitHook(data_manager.after_commit)
+        data_managers[1][flush] = data_manager
+    return data_manager
+
+
+def get_pending_tasks(flush):
+    """Returns the tasks added in the current transaction that are pending to
+    be flushed with the function passed-in
+    :param flush: function that adds the tasks passed-in to the queue
+    :return: list of tasks pending to be flushed
+    :rtype: list
+    """
+    data_manager = _get_current_data_manager(flush)
+    if data_manager is None:
+        return []
+    return list(data_manager.tasks)
+
+
+def discard_pending_tasks(flush, task_uids):
+    """Removes the tasks with the task uids passed-in from the tasks added in
+    the current transaction that are pending to be flushed with the function
+    passed-in, so they never reach the queue
+    :param flush: function that adds the tasks passed-in to the queue
+    :param task_uids: list of task uids to discard
+    """
+    data_manager = _get_current_data_manager(flush)
+    if data_manager is None:
+        return
+    task_uids = set(task_uids)
+    tasks = filter(lambda t: t.task_uid not in task_uids, data_manager.tasks)
+    data_manager.tasks = tasks
+
+
+def _get_current_data_manager(flush):
+    """Returns the data manager joined to the current transaction that flushes
+    the tasks with the function passed-in, if any
+    """
+    data_managers = getattr(_local, "data_managers", None)
+    if data_managers is None or data_managers[0] is not transaction.get():
+        return None
+    return data_managers[1].get(flush)
@@ -62,7 +62,7 @@ class IQueueUtility(Interface):
     """
 
     def add(self, task):
-        """Adds a task to the queue
+        """Adds a task to the queue once the current transaction is committed
         :param task: the QueueTask to add
         """
 
@@ -73,6 +73,16 @@ class IQueueUtility(Interface):
         :rtype: queue.QueueTask
         """
 
+    def pop_many(self, consumer_id, max_tasks):
+        """Returns up to max_tasks tasks to process, if any. The tasks are
+        meant to be processed one after the other by the same consumer
+        :param consumer_id: id of the consumer thread that will process the
+            tasks
+        :param max_tasks: max number of tasks to return
+        :return: list of tasks to be processed
+        :rtype: list
+        """
+
     def done(self, task):
         """Notifies the queue that the task has been processed successfully
         :param task: task's unique id (task_uid) or QueueTask object
@@ -89,11 +99,43 @@ class IQueueUtility(Interface):
         :param task: task's unique id (task_uid) or QueueTask object
         """
 
+    def heartbeat(self, consumer_id):
+        """Renews the lease of the running tasks of the consumer passed-in, so
+        they are not re-queued while the consumer is processing them
+        :param consumer_id: id of the consumer thread that is processing tasks
+        :return: list of the task uids the consumer holds the lease of
+        :rtype: list
+        """
+
+    def ack(self, done=None, failed=None, timeout=None, conflicts=None,
+            consumer_id=None):
+        """Notifies the queue about the outcome of the processing of several
+        tasks at once. Tasks that are not running are skipped
+        :param done: list of task uids processed successfully
+        :param failed: dict of task uids whose processing failed, with the
+            error/traceback as values
+        :param timeout: list of task uids whose processing timed out
+        :param conflicts: dict of task uids with the number of conflict
+            errors the consumer came across while processing them
+        :param consumer_id: (Optional) id of the consumer that processed the
+            tasks. If set, the tasks running for other consumers are skipped
+        :return: list of the task uids acknowledged by the queue
+        :rtype: list
+        """
+
     def delete(self, task):
         """Removes a task from the queue
         :param task: task's unique id (task_uid) or QueueTask object
         """
 
+    def requeue(self, task):
+        """Re-queues the task with the max number of retries restored, when
+        the current transaction is committed
+        :param task: task's unique id (task_uid) or QueueTask object
+        :return: the task to be re-queued or None if not found
+        :rtype: queue.QueueTask
+        """
+
     def get_task(self, task_uid):
         """Returns the task with the given task uid
         :param task_uid: task's unique id
@@ -109,6 +151,15 @@ class IQueueUtility(Interface):
         :rtype: iterator
         """
 
+    def get_tasks_page(self, status=None, name=None, username=None,
+                       since=None, sort_on=None, sort_order=None, offset=0,
+                       limit=None):
+        """Returns a tuple (tasks, total) with the page of tasks with the
+        given status that match with the criteria passed-in, along with the
+        total number of tasks that match with the criteria. Each task has its
+        position in the queue in "position"
+        """
+
     def get_uids(self, status=None):
         """Returns a list with the uids from the queue
         :param status: (Optional) a string or list with status. If None, only
@@ -117,6 +168,12 @@ class IQueueUtility(Interface):
         :rtype: list
         """
 
+    def iter_uids(self, status=None):
+        """Returns an iterator over the uids from the queue, without duplicates
+        :param status: (Optional) a string or list with status. If None, only
+            "running" and "queued" are considered
+        """
+
     def get_tasks_for(self, context_or_uid, name=None):
         """Returns a list with the queued or running tasks the queue contains
         for the given context and name, if provided. Failed tasks are not
@@ -149,6 +206,11 @@ class IQueueUtility(Interface):
         :rtype: bool
         """
 
+    def get_revision(self):
+        """Returns a value that changes whenever the tasks from the queue
+        change, tasks pending to be added in current transaction included
+        """
+
 
 class IServerQueueUtility(IQueueUtility):
     """Marker interface for Queue global utility (singleton) used by the zeo
@@ -165,8 +227,39 @@ class IServerQueueUtility(IQueueUtility):
         """Returns whether the queue is busy
         """
 
+    def get_concurrency(self):
+        """Returns a dict with the max number of tasks to process at the same
+        time, its bounds, the average number of seconds tasks take to be
+        processed and the history of changes of the max number of tasks
+        """
+
+    def get_metrics(self):
+        """Returns the registry with the counters and histograms of the events
+        of the queue (e.g. wait and run time of tasks, failures, timeouts)
+        """
+
     def purge(self):
-        """Purges the queue of invalid/stuck tasks
+        """Re-queues the running tasks of the consumers whose lease expired
+        """
+
+    def recover(self):
+        """Restores the tasks from the journal, if a journal is configured
+        """
+
+    def get_version(self):
+        """Returns a tuple (epoch, version) that represents the current version
+        of the queue
+        """
+
+    def get_changes(self, version, epoch=None):
+        """Returns a dict with the tasks added or changed and the uids of tasks
+        removed since the version passed-in, or None if the changes since that
+        version are unknown
+        """
+
+    def wait_for_changes(self, version, epoch=None, timeout=20):
+        """Blocks until the queue changes after the version passed-in or until
+        the timeout expires. Returns whether the queue changed
         """
 
 
@@ -183,3 +276,19 @@ class IClientQueueUtility(IQueueUtility):
     def sync(self):
         """Synchronizes the client queue utility with the queue server
         """
+
+    def get_staleness(self):
+        """Returns the seconds elapsed since the last successful synchronization
+        with the queue server
+        """
+
+    def is_listening(self):
+        """Returns whether the background thread that keeps the client queue
+        utility up-to-date with the queue server is running
+        """
+
+    def listen(self):
+        """Starts the background thread that keeps the client queue utility
+        up-to-date with the queue server. Synchronizes the client queue utility
+        right away if it has never been synchronized
+        """
@@ -155,10 +155,9 @@ def _apply_worksheet_template_routine_analyses(self, wst):
         # Queue the assignment of analyses
         analyses, slots = zip(*analyses_slots)
 
-        # Be sure that nobody else other than us is applying a template and add
-        # some delay to prevent the consumers to start processing while the
-        # life-cycle of current request has not yet finished
-        kwargs = {"unique": True, "delay": 5}
+        # Be sure that nobody else other than us is applying a template. The
+        # task only reaches the queue once current transaction is committed
+        kwargs = {"unique": True}
         api.add_assign_task(self, analyses=analyses, slots=slots, **kwargs)
 
         # Reindex the worksheet to update the WorksheetTemplate meta column
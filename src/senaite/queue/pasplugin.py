@@ -20,8 +20,10 @@
 
 import base64
 import os
-
+import threading
 import time
+from collections import OrderedDict
+
 from AccessControl.class_init import InitializeClass
 from cryptography.fernet import Fernet
 from plone import api as ploneapi
@@ -36,6 +38,25 @@ from senaite.queue.interfaces import ISenaiteQueueLayer
 from bika.lims import api
 from bika.lims.utils import to_unicode
 
+# Seconds an auth token is valid since its creation
+TOKEN_TTL = 10
+
+# Seconds before the expiration an auth token is no longer reused
+TOKEN_RENEW = 3
+
+# Maximum number of auth tokens to keep in cache, either encrypted or decrypted
+MAX_CACHED_TOKENS = 256
+
+# Auth tokens encrypted for outgoing requests, keyed by (username, key)
+_encrypted = {}
+
+# Auth tokens decrypted from incoming requests (LRU), keyed by auth token
+_decrypted = OrderedDict()
+_decrypted_lock = threading.Lock()
+
+# Last Fernet instance used, as a tuple (key, fernet)
+_fernet = (None, None)
+
 
 class QueueAuthPlugin(BasePlugin):
     """PAS Authentication Plugin for senaite.queue
@@ -69,20 +90,15 @@ class QueueAuthPlugin(BasePlugin):
             return {}
 
         # Decrypt the auth_token
-        key = api.get_registry_record("senaite.queue.auth_key")
-        token = Fernet(str(key)).decrypt(auth_token)
-
-        # Check if token is valid
-        tokens = token.split(":")
-        if len(tokens) < 2 or not api.is_floatable(tokens[0]):
+        token = decrypt_auth_token(auth_token)
+        if not token:
             return {}
 
         # Check if token has expired
-        expiration = api.to_float(tokens[0])
+        expiration, user_id = token
         if expiration < time.time():
             return {}
 
-        user_id = "".join(tokens[1:])
         return {"login": user_id}
 
     def authenticateCredentials(self, credentials):  # noqa camelCase
@@ -122,20 +138,84 @@ class QueueAuth(AuthBase):
         self.key = key
 
     def __call__(self, r):
-        # We want our key to be valid for 10 seconds only
-        secs = time.time() + 10
-        token = "{}:{}".format(secs, self.username)
-
         # Encrypt the token using our symmetric auth key
         if not self.key:
             self.key = api.get_registry_record("senaite.queue.auth_key")
-        auth_token = Fernet(str(self.key)).encrypt(token)
+        auth_token = get_auth_token(self.username, self.key)
 
         # Modify and return the request
         r.headers["X-Queue-Auth-Token"] = auth_token
         return r
 
 
+def get_fernet(key):
+    """Returns the Fernet instance for the symmetric encryption with the key
+    passed-in. The instance is kept and only rebuilt when the key changes
+    """
+    global _fernet
+    current_key, fernet = _fernet
+    if key != current_key or fernet is None:
+        fernet = Fernet(str(key))
+        _fernet = (key, fernet)
+    return fernet
+
+
+def get_auth_token(username, key):
+    """Returns an encrypted token with the username and its expiration date.
+    Tokens are valid for a few seconds only, but the same token is reused for
+    same username and key until shortly before it expires
+    :param username: the user to authenticate as
+    :param key: the key for the symmetric encryption of the token
+    :return: the encrypted token
+    """
+    now = time.time()
+    cached = _encrypted.get((username, key))
+    if cached and cached[0] - TOKEN_RENEW > now:
+        return cached[1]
+
+    # We want our token to be valid for a few seconds only
+    expiration = now + TOKEN_TTL
+    token = "{}:{}".format(expiration, username)
+    auth_token = get_fernet(key).encrypt(token)
+
+    if len(_encrypted) >= MAX_CACHED_TOKENS:
+        _encrypted.clear()
+    _encrypted[(username, key)] = (expiration, auth_token)
+    return auth_token
+
+
+def decrypt_auth_token(auth_token):
+    """Returns a tuple (expiration, username) with the information from the
+    encrypted token passed-in, or None if the token is not valid. Decrypted
+    tokens are kept in a LRU cache, so tokens reused by clients are decrypted
+    only once. Since tokens expire within seconds, tokens from the cache are
+    not checked against the current key. Expiration has to be checked by the
+    caller
+    :param auth_token: the encrypted token
+    """
+    with _decrypted_lock:
+        token = _decrypted.pop(auth_token, None)
+        if token:
+            # Move to the end, so this token is the last to be discarded
+            _decrypted[auth_token] = token
+            return token
+
+    key = api.get_registry_record("senaite.queue.auth_key")
+    token = get_fernet(key).decrypt(auth_token)
+
+    # Check if token is valid
+    tokens = token.split(":")
+    if len(tokens) < 2 or not api.is_floatable(tokens[0]):
+        return None
+
+    token = (api.to_float(tokens[0]), "".join(tokens[1:]))
+    with _decrypted_lock:
+        _decrypted[auth_token] = token
+        while len(_decrypted) > MAX_CACHED_TOKENS:
+            _decrypted.popitem(last=False)
+    return token
+
+
 def add_queue_auth_plugin():
     # Form for manually adding the plugin, but we always do in setup handler
     pass
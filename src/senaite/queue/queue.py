@@ -18,6 +18,8 @@
 # Copyright 2019-2021 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
+import binascii
+import copy
 import six
 import time
 
@@ -27,12 +29,56 @@ from bika.lims.utils import tmpID
 _marker = object()
 
 
-class QueueTask(dict):
-    """A task for queueing
+# Attributes all tasks have, stored in slots
+TASK_FIELDS = (
+    "task_uid",
+    "name",
+    "context_uid",
+    "context_path",
+    "uids",
+    "created",
+    "status",
+    "error_message",
+    "min_seconds",
+    "max_seconds",
+    "priority",
+    "retries",
+    "unique",
+    "chunk_size",
+    "username",
+)
+
+# Attributes whose values are repeated across tasks and are interned
+INTERNED_FIELDS = ("name", "context_path", "status", "username")
+
+# Seconds the lease a consumer takes on the tasks it pops lasts, unless renewed
+LEASE_TTL = 15
+
+# Attributes tasks can be sorted by, besides their position in the queue
+SORTABLE_FIELDS = ("created", "name", "context_path", "username", "status")
+
+
+class QueueTask(object):
+    """A task for queueing. Behaves like a dict, but the attributes all tasks
+    have are stored in slots and the rest (e.g. "action") in a dict of extras.
+    Names, paths and usernames are interned and uids are packed as bytes, so
+    many tasks can be kept in memory with a small footprint.
+
+    A task can be frozen: a frozen task cannot be modified, so it can be
+    shared without the need of copying it
     """
+    __slots__ = tuple(map(lambda f: "_" + f, TASK_FIELDS)) + (
+        "_extras",
+        "_frozen",
+    )
+
+    # Tasks are mutable by default, so they are not hashable
+    __hash__ = None
 
     def __init__(self, name, request, context, *arg, **kw):
-        super(QueueTask, self).__init__(*arg, **kw)
+        self._frozen = False
+        self._extras = {}
+        kw = dict(*arg, **kw)
         if api.is_uid(context):
             context_uid = context
             context_path = kw.get("context_path")
@@ -46,19 +92,28 @@ class QueueTask(dict):
         else:
             raise TypeError("No valid context object")
 
-        # Set defaults
-        kw = kw or {}
-        task_uid = str(kw.get("task_uid", tmpID()))
-        uids = map(str, kw.get("uids", []))
-        created = api.to_float(kw.get("created"), default=time.time())
+        # Keep the attributes that are not known
+        for key, value in kw.items():
+            if key not in TASK_FIELDS:
+                self._extras[key] = value
+
+        # Set defaults. Defaults are only computed when no value is provided,
+        # so no registry look-up is done for tasks created from a dict
+        task_uid = str(kw.get("task_uid") or tmpID())
+        uids = kw.get("uids") or []
+        created = self._to_float(kw.get("created"), time.time)
         status = kw.get("status", None)
-        min_sec = api.to_int(kw.get("min_seconds"), default=get_min_seconds())
-        max_sec = api.to_int(kw.get("max_seconds"), default=get_max_seconds())
-        priority = api.to_int(kw.get("priority"), default=10)
-        retries = api.to_int(kw.get("retries"), default=get_max_retries())
+        min_sec = self._to_int(kw.get("min_seconds"), get_min_seconds)
+        max_sec = self._to_int(kw.get("max_seconds"), get_max_seconds)
+        priority = self._to_int(kw.get("priority"), lambda: 10)
+        retries = self._to_int(kw.get("retries"), get_max_retries)
         unique = self._is_true(kw.get("unique", False))
-        chunks = api.to_int(kw.get("chunk_size"), default=get_chunk_size(name))
-        username = kw.get("username", self._get_authenticated_user(request))
+        chunks = self._to_int(kw.get("chunk_size"),
+                              lambda: get_chunk_size(name))
+        if "username" in kw:
+            username = kw.get("username")
+        else:
+            username = self._get_authenticated_user(request)
         err_message = kw.get("error_message", None)
 
         self.update({
@@ -84,6 +139,24 @@ class QueueTask(dict):
         """
         return str(val).lower() in ["y", "yes", "1", "true"]
 
+    def _to_int(self, value, default):
+        """Returns the value as an integer. The callable default is only called
+        when the value is not valid
+        """
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return default()
+
+    def _to_float(self, value, default):
+        """Returns the value as a float. The callable default is only called
+        when the value is not valid
+        """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default()
+
     def _get_authenticated_user(self, request):
         authenticated_user = request.get("AUTHENTICATED_USER")
         if authenticated_user:
@@ -98,11 +171,11 @@ class QueueTask(dict):
 
     @property
     def name(self):
-        return self["name"]
+        return self._name
 
     @property
     def task_uid(self):
-        return self["task_uid"]
+        return self._task_uid
 
     @property
     def task_short_uid(self):
@@ -110,7 +183,7 @@ class QueueTask(dict):
 
     @property
     def context_uid(self):
-        return self["context_uid"]
+        return self._context_uid
 
     @property
     def request(self):
@@ -118,19 +191,19 @@ class QueueTask(dict):
 
     @property
     def priority(self):
-        return self["priority"]
+        return self._priority
 
     @property
     def status(self):
-        return self["status"]
+        return self._status
 
     @property
     def created(self):
-        return self["created"]
+        return self._created
 
     @property
     def retries(self):
-        return self["retries"]
+        return self._retries
 
     @retries.setter
     def retries(self, value):
@@ -138,11 +211,16 @@ class QueueTask(dict):
 
     @property
     def uids(self):
-        return self["uids"]
+        """Returns the list of uids of the task, or a tuple if it is frozen
+        """
+        uids = unpack_uids(self._uids)
+        if self._frozen:
+            return uids
+        return list(uids)
 
     @property
     def username(self):
-        return self["username"]
+        return self._username
 
     @username.setter
     def username(self, value):
@@ -150,14 +228,200 @@ class QueueTask(dict):
 
     @property
     def context_path(self):
-        return self["context_path"]
+        return self._context_path
 
     def get_context(self):
         return api.get_object_by_uid(self.context_uid)
 
+    def is_frozen(self):
+        """Returns whether this task is immutable
+        """
+        return self._frozen
+
+    def freeze(self):
+        """Returns an immutable copy of this task, or the task itself if is
+        frozen already. Lists are converted to tuples
+        """
+        if self._frozen:
+            return self
+        return self.copy_with(_frozen=True)
+
+    def thaw(self):
+        """Returns a mutable copy of this task. Tuples are converted to lists
+        """
+        return self.copy_with(_frozen=False)
+
+    def copy_with(self, _frozen=None, **kwargs):
+        """Returns a shallow copy of this task, with the values from kwargs. The
+        copy is frozen if this task is frozen, unless otherwise specified
+        """
+        frozen = self._frozen if _frozen is None else _frozen
+        convert = frozen and self._to_immutable or self._to_mutable
+        task = self.__class__.__new__(self.__class__)
+        for slot in self.__slots__:
+            setattr(task, slot, getattr(self, slot))
+        task._frozen = False
+        task._extras = dict(map(lambda i: (i[0], convert(i[1])),
+                                self._extras.items()))
+        task.update(map(lambda i: (i[0], convert(i[1])), kwargs.items()))
+        task._frozen = frozen
+        return task
+
+    def to_dict(self):
+        """Returns the dict representation of this task, suitable for JSON
+        """
+        out = dict(self._extras)
+        for key in TASK_FIELDS:
+            out[key] = self[key]
+        return out
+
+    def _to_immutable(self, value):
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    def _to_mutable(self, value):
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError("Task {} is frozen".format(self.task_short_uid))
+
+    def __getitem__(self, key):
+        if key in TASK_FIELDS:
+            if key == "uids":
+                return self.uids
+            return getattr(self, "_" + key)
+        return self._extras[key]
+
+    def __setitem__(self, key, value):
+        self._check_mutable()
+        if key not in TASK_FIELDS:
+            self._extras[key] = value
+        elif key == "uids":
+            self._uids = pack_uids(value)
+        elif key in INTERNED_FIELDS:
+            setattr(self, "_" + key, to_interned(value))
+        else:
+            setattr(self, "_" + key, value)
+
+    def __delitem__(self, key):
+        self._check_mutable()
+        if key in TASK_FIELDS:
+            raise KeyError("{} cannot be removed".format(key))
+        del self._extras[key]
+
+    def __contains__(self, key):
+        return key in TASK_FIELDS or key in self._extras
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(TASK_FIELDS) + len(self._extras)
+
+    def keys(self):
+        return list(TASK_FIELDS) + self._extras.keys()
+
+    def values(self):
+        return map(lambda key: self[key], self.keys())
+
+    def items(self):
+        return map(lambda key: (key, self[key]), self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def update(self, *args, **kwargs):
+        self._check_mutable()
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        self._check_mutable()
+        if key in TASK_FIELDS:
+            raise KeyError("{} cannot be removed".format(key))
+        return self._extras.pop(key, *args)
+
+    def __copy__(self):
+        if self._frozen:
+            return self
+        return self.copy_with()
+
+    def __deepcopy__(self, memo):
+        if self._frozen:
+            # Frozen tasks are immutable, no need to copy
+            return self
+        task = self.copy_with()
+        memo[id(self)] = task
+        task._extras = copy.deepcopy(task._extras, memo)
+        return task
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
     def __eq__(self, other):
         return other and self.task_uid == other.task_uid
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def to_interned(value):
+    """Returns the interned version of the string passed-in, so tasks with same
+    name, path or username share the same string object
+    """
+    if value is None:
+        return None
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode("utf-8")
+    return six.moves.intern(str(value))
+
+
+def pack_uids(uids):
+    """Returns the uids passed-in as a compact bytes string, with each uid
+    packed as a 16-bytes value. Returns a tuple of strings if not all uids are
+    32-chars hexadecimal values
+    """
+    uids = tuple(map(str, uids or []))
+    if not all(map(lambda uid: len(uid) == 32 and uid == uid.lower(), uids)):
+        return uids
+    try:
+        return b"".join(map(binascii.unhexlify, uids))
+    except (TypeError, ValueError):
+        return uids
+
+
+def unpack_uids(packed):
+    """Returns the tuple of uids from a value packed with pack_uids
+    """
+    if isinstance(packed, tuple):
+        return packed
+    hexlify = binascii.hexlify
+    return tuple(map(lambda i: hexlify(packed[i:i + 16]),
+                     range(0, len(packed), 16)))
+
 
 def new_task(name, context, **kw):
     """Creates a QueueTask
@@ -211,6 +475,65 @@ def to_task(task_dict):
     return QueueTask(name, api.get_request(), context_uid, **kwargs)
 
 
+def get_tasks_page(tasks, sort_key, status=None, name=None, username=None,
+                   since=None, sort_on=None, sort_order=None, offset=0,
+                   limit=None):
+    """Returns a tuple (tasks, total) with the page of tasks from the list
+    passed-in that match with the criteria, along with the total number of
+    tasks that match with the criteria. Ghost tasks are skipped unless "ghost"
+    is one of the status passed-in. Each task from the page is a copy with
+    its position among the running and queued tasks in "position", or 0 if
+    the task is neither running nor queued
+    :param tasks: list of tasks to filter, sort and paginate
+    :param sort_key: function that returns the key to sort a task by its
+        position in the queue
+    :param status: (Optional) list of status the tasks were retrieved for
+    :param name: (Optional) name of the tasks to keep
+    :param username: (Optional) username of the tasks to keep
+    :param since: (Optional) keep the tasks created after this time only
+    :param sort_on: (Optional) attribute to sort the tasks by. If None or
+        not sortable, tasks are sorted by their position in the queue
+    :param sort_order: (Optional) "ascending" (default) or "descending"
+    :param offset: (Optional) number of tasks to skip
+    :param limit: (Optional) max number of tasks to return
+    """
+    # Position of the running and queued tasks in the queue
+    active = filter(lambda t: t.status in ["running", "queued"], tasks)
+    active = sorted(active, key=sort_key)
+    positions = dict([(t.task_uid, idx + 1) for idx, t in enumerate(active)])
+
+    # Skip ghosts unless explicitly asked
+    if "ghost" not in (status or []):
+        tasks = filter(lambda t: not t.get("ghost"), tasks)
+    if name:
+        tasks = filter(lambda t: t.name == name, tasks)
+    if username:
+        tasks = filter(lambda t: t.username == username, tasks)
+    if since:
+        since = api.to_float(since, default=0)
+        tasks = filter(lambda t: t.created > since, tasks)
+
+    # Sort the tasks, by their position in the queue when tied
+    key = sort_key
+    if sort_on in SORTABLE_FIELDS:
+        key = lambda t: (t.get(sort_on), sort_key(t))  # noqa
+    reverse = sort_order in ["descending", "reverse"]
+    tasks = sorted(tasks, key=key, reverse=reverse)
+
+    # Paginate
+    total = len(tasks)
+    offset = max(api.to_int(offset, default=0), 0)
+    limit = api.to_int(limit, default=0)
+    if limit > 0:
+        tasks = tasks[offset:offset + limit]
+    else:
+        tasks = tasks[offset:]
+
+    tasks = map(lambda t: t.copy_with(position=positions.get(t.task_uid, 0)),
+                tasks)
+    return tasks, total
+
+
 def is_task(task):
     """Returns whether the value passed in is a task
     """
@@ -218,7 +541,9 @@ def is_task(task):
 
 
 def get_min_seconds(default=3):
-    """Returns the minimum number of seconds to book per task
+    """Returns the minimum number of seconds to book per task. Deprecated:
+    tasks reach the queue once the transaction is committed, so consumers no
+    longer wait for this time to elapse
     """
     registry_id = "senaite.queue.min_seconds_task"
     min_seconds = api.get_registry_record(registry_id)
@@ -226,6 +551,87 @@ def get_min_seconds(default=3):
     return min_seconds >= 1 and min_seconds or default
 
 
+def get_consumer_workers(default=1):
+    """Returns the number of worker threads each consumer (zeo client) runs to
+    process tasks concurrently
+    """
+    registry_id = "senaite.queue.consumer_workers"
+    workers = api.get_registry_record(registry_id)
+    workers = api.to_int(workers, default=default)
+    return workers >= 1 and workers or default
+
+
+def get_lease_expiry():
+    """Returns the time since epoch when a lease that is taken or renewed now
+    expires
+    """
+    return time.time() + LEASE_TTL
+
+
+def get_concurrency_bounds(default_min=1, default_max=16):
+    """Returns a tuple (min, max) with the bounds of the number of tasks the
+    queue server allows to be processed at the same time
+    """
+    min_limit = api.get_registry_record("senaite.queue.min_concurrency")
+    min_limit = max(api.to_int(min_limit, default=default_min), 1)
+    max_limit = api.get_registry_record("senaite.queue.max_concurrency")
+    max_limit = api.to_int(max_limit, default=default_max)
+    return min_limit, max(min_limit, max_limit)
+
+
+def get_long_poll_clients(default=0):
+    """Returns the max number of requests for changes from clients the queue
+    server holds at a time (long-polling). Other clients fall back to polling.
+    Each request held keeps a thread busy, so this number is always lower
+    than the number of threads of the current zeo client, if known
+    """
+    registry_id = "senaite.queue.long_poll_clients"
+    clients = api.get_registry_record(registry_id)
+    clients = api.to_int(clients, default=default)
+
+    # Keep at least one thread free for the rest of requests
+    threads = get_zserver_threads()
+    if threads:
+        clients = min(clients, threads - 1)
+    return max(clients, 0)
+
+
+def get_zserver_threads():
+    """Returns the number of threads of the current zeo client, as set in
+    the zserver-threads setting of zope.conf, or None if unknown
+    """
+    try:
+        from App.config import getConfiguration
+        threads = getattr(getConfiguration(), "zserver_threads", None)
+    except ImportError:
+        return None
+    return api.to_int(threads, default=None)
+
+
+def get_consumer_prefetch(default=1):
+    """Returns the max number of tasks each worker of a consumer pulls from
+    the queue at once, to be processed one after the other
+    """
+    registry_id = "senaite.queue.consumer_prefetch"
+    prefetch = api.get_registry_record(registry_id)
+    prefetch = api.to_int(prefetch, default=default)
+    return prefetch >= 1 and prefetch or default
+
+
+def get_consumer_id(host, worker):
+    """Returns the consumer id of the worker number passed-in for the consumer
+    (zeo client) with the given host
+    """
+    return "{}#{}".format(host, worker)
+
+
+def get_consumer_host(consumer_id):
+    """Returns the host of the consumer (zeo client) the consumer id passed-in
+    belongs to. Consumer ids have the format "<host>#<worker number>"
+    """
+    return (consumer_id or "").split("#")[0]
+
+
 def get_max_seconds(default=120):
     """Returns the max number of seconds to wait for a task to finish
     """
@@ -287,6 +693,13 @@ def get_chunks(items, chunk_size):
     return [items[:chunk_size], items[chunk_size:]]
 
 
+def is_conflict_error(error_message):
+    """Returns whether the error message passed-in is from a conflict error
+    in the database while processing a task
+    """
+    return "ConflictError" in str(error_message or "")
+
+
 def get_task_uid(task_or_uid, default=_marker):
     """Returns the task unique identifier
     :param task_or_uid: QueueTask/task uid/dict
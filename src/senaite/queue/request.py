@@ -30,6 +30,7 @@ from senaite.jsonapi import api as japi
 from senaite.jsonapi.exceptions import APIError
 from senaite.queue import logger
 from six.moves.urllib import parse
+from ZODB.POSException import ConflictError
 
 from bika.lims import api as capi
 
@@ -127,6 +128,9 @@ def handle_queue_errors(func):
             fail(status, message)
         except APIError as e:
             raise e
+        except ConflictError:
+            # Let ZPublisher retry the request
+            raise
         except Exception as e:
             traceback.print_exc()
             msg = "{}: {}".format(type(e).__name__, str(e))
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import itertools
+import json
+import os
+import six
+import threading
+import time
+from collections import OrderedDict
+
+from senaite.queue import logger
+
+# Name of the file where the events are appended
+JOURNAL_FILE = "queue.journal"
+
+# Name of the file where the journal is moved to when a snapshot is taken,
+# until the snapshot is stored
+ROTATED_JOURNAL_FILE = "queue.journal.1"
+
+# Name of the file where the snapshots of the queue are stored
+SNAPSHOT_FILE = "queue.snapshot"
+
+# Number of events to append to the journal before a snapshot is taken
+SNAPSHOT_EVERY = 1000
+
+# Seconds to wait between consecutive syncs of the journal to disk
+SYNC_INTERVAL = 0.5
+
+
+class QueueJournal(object):
+    """Append-only journal of the events (add, pop, done, fail, timeout and
+    delete) of the server's queue, compacted into snapshots periodically.
+
+    Each event is written to the journal file as soon as it is recorded, so
+    it survives a crash of the process. Events are synced to disk in groups
+    by a background thread every `sync_interval` seconds instead of once per
+    event, so the throughput of the queue is not bound to disk latency. The
+    same thread stores the snapshots
+    """
+
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY,
+                 sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.sync_interval = sync_interval
+        self._seq = 0
+        self._since_snapshot = 0
+        self._dirty = False
+        self._file = None
+        self._syncer = None
+        self._snapshot = None
+        self.__lock = threading.Lock()
+        self.__snapshot_lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.directory, JOURNAL_FILE)
+
+    @property
+    def rotated_journal_path(self):
+        return os.path.join(self.directory, ROTATED_JOURNAL_FILE)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    def record(self, event, task_uid, task=None):
+        """Appends an event to the journal
+        :param event: name of the event (add, pop, done, fail, etc.)
+        :param task_uid: the uid of the task the event refers to
+        :param task: (Optional) the task, with the state it has after the
+            event took place. If None, the task is no longer in the queue
+        """
+        with self.__lock:
+            self._seq += 1
+            record = {
+                "seq": self._seq,
+                "event": event,
+                "task_uid": task_uid,
+            }
+            if task is not None:
+                record["task"] = dict(task)
+
+            # Write the event right away. Sync to disk is done in background
+            journal = self._get_file()
+            journal.write(json.dumps(record) + "\n")
+            journal.flush()
+            self._since_snapshot += 1
+            self._dirty = True
+
+        self._start_syncer()
+
+    def needs_snapshot(self):
+        """Returns whether the journal has grown enough to be compacted into a
+        snapshot
+        """
+        return self._since_snapshot >= self.snapshot_every
+
+    def snapshot(self, tasks):
+        """Takes a snapshot with the tasks passed-in. The journal is rotated
+        right away, so the events recorded afterwards go to a new journal, but
+        the snapshot is stored on next sync, so the caller does not wait for
+        the disk. Tasks are not copied, so they must be frozen
+        :param tasks: list of tasks the queue contains
+        """
+        with self.__lock:
+            # Events up to this seq will be in the snapshot. The rotated
+            # journal is kept until the snapshot is stored. If there is a
+            # rotated journal already (the previous snapshot is not stored
+            # yet), events are skipped on recovery because of their seq
+            if not os.path.exists(self.rotated_journal_path):
+                if self._file is not None:
+                    self._file.flush()
+                    self._file.close()
+                    self._file = None
+                if os.path.exists(self.journal_path):
+                    os.rename(self.journal_path, self.rotated_journal_path)
+
+            self._snapshot = (self._seq, list(tasks))
+            self._since_snapshot = 0
+
+        self._start_syncer()
+
+    def recover(self):
+        """Returns the tasks (as dicts) from the last snapshot, with the events
+        recorded in the journal afterwards replayed on top
+        :return: list of dicts representing tasks, sorted by insertion order
+        :rtype: list
+        """
+        with self.__lock:
+            tasks = OrderedDict()
+            snapshot_seq = 0
+            snapshot = self._read_snapshot()
+            if snapshot:
+                snapshot_seq = snapshot.get("seq", 0)
+                for task in snapshot.get("tasks", []):
+                    tasks[task["task_uid"]] = task
+
+            # Drop the last event if it was not completely written before a
+            # crash, so next events are not appended to it
+            self._truncate_torn_event()
+
+            # Replay the tail of the journal, rotated journal first
+            replayed = 0
+            records = itertools.chain(
+                self._read_journal(self.rotated_journal_path),
+                self._read_journal(self.journal_path))
+            for record in records:
+                seq = record.get("seq", 0)
+                self._seq = max(self._seq, seq)
+                if seq <= snapshot_seq:
+                    continue
+                task_uid = record.get("task_uid")
+                task = record.get("task")
+                if task is None:
+                    tasks.pop(task_uid, None)
+                else:
+                    tasks[task_uid] = task
+                replayed += 1
+
+            self._seq = max(self._seq, snapshot_seq)
+            self._since_snapshot = replayed
+
+        logger.info("Queue recovered: {} tasks ({} events replayed)"
+                    .format(len(tasks), replayed))
+        return tasks.values()
+
+    def sync(self):
+        """Syncs the events written to the journal to disk and stores the
+        snapshot taken since last sync, if any
+        """
+        with self.__lock:
+            if self._dirty and self._file:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+        self._store_snapshot()
+
+    def _store_snapshot(self):
+        """Stores the last snapshot taken, if not stored yet, and removes the
+        rotated journal afterwards
+        """
+        with self.__snapshot_lock:
+            with self.__lock:
+                snapshot, self._snapshot = self._snapshot, None
+            if snapshot is None:
+                return
+
+            seq, tasks = snapshot
+            data = {
+                "seq": seq,
+                "created": time.time(),
+                "tasks": map(dict, tasks),
+            }
+
+            # Events from the rotated journal must be on disk before they are
+            # removed, in case the snapshot cannot be stored
+            self._fsync_path(self.rotated_journal_path)
+
+            # Write the snapshot in a temporary file and atomically replace
+            # the previous snapshot, so there is always a valid snapshot
+            tmp_path = "{}.tmp".format(self.snapshot_path)
+            with open(tmp_path, "w") as tmp_file:
+                json.dump(data, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.rename(tmp_path, self.snapshot_path)
+            self._fsync_directory()
+
+            # Events from the rotated journal are in the snapshot already
+            with self.__lock:
+                if os.path.exists(self.rotated_journal_path):
+                    os.remove(self.rotated_journal_path)
+
+        logger.info("Queue snapshot stored: {} tasks [seq={}]"
+                    .format(len(data["tasks"]), data["seq"]))
+
+    def close(self):
+        """Syncs the pending events and closes the journal
+        """
+        self.sync()
+        with self.__lock:
+            self._close_file()
+
+    def _get_file(self):
+        if self._file is None:
+            self._truncate_torn_event()
+            self._file = open(self.journal_path, "a")
+        return self._file
+
+    def _truncate_torn_event(self):
+        """Truncates the journal after the last complete event, if the last
+        event was not completely written before a crash
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb+") as journal_file:
+            journal_file.seek(0, os.SEEK_END)
+            position = journal_file.tell()
+            if position == 0:
+                return
+            journal_file.seek(-1, os.SEEK_END)
+            if journal_file.read(1) == b"\n":
+                return
+
+            # Look for the last line break backwards, block by block
+            end = 0
+            while position > 0:
+                size = min(4096, position)
+                position -= size
+                journal_file.seek(position)
+                index = journal_file.read(size).rfind(b"\n")
+                if index >= 0:
+                    end = position + index + 1
+                    break
+
+            journal_file.truncate(end)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        logger.warn("Truncated corrupt event from queue journal")
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _fsync_path(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as path_file:
+            os.fsync(path_file.fileno())
+
+    def _fsync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, "r") as snapshot_file:
+            return json.load(snapshot_file, object_hook=to_native)
+
+    def _read_journal(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line, object_hook=to_native)
+                except ValueError:
+                    # Last event was not completely written before a crash
+                    logger.warn("Skipping corrupt event from queue journal")
+
+    def _start_syncer(self):
+        if self._syncer and self._syncer.is_alive():
+            return
+        with self.__lock:
+            if self._syncer and self._syncer.is_alive():
+                return
+            self._syncer = threading.Thread(target=self._sync_loop,
+                                            name="senaite.queue.journal")
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except (IOError, OSError, ValueError) as e:
+                logger.error("Cannot sync the queue journal: {}".format(e))
+
+
+def to_native(value):
+    """Converts the unicode strings from the value passed-in to native strings
+    """
+    if isinstance(value, dict):
+        return dict([(to_native(k), to_native(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return map(to_native, value)
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode("utf-8")
+    return value
+
+
+def get_journal():
+    """Returns the journal for the server's queue, as configured in the
+    product-config section of zope.conf, if any:
+
+        <product-config senaite.queue>
+            journal_dir /path/to/var/queue
+        </product-config>
+
+    :return: the journal or None if no journal directory is configured
+    :rtype: QueueJournal
+    """
+    try:
+        from App.config import getConfiguration
+        product_config = getattr(getConfiguration(), "product_config", None)
+    except ImportError:
+        return None
+
+    config = (product_config or {}).get("senaite.queue") or {}
+    directory = config.get("journal_dir")
+    if not directory:
+        return None
+
+    snapshot_every = config.get("journal_snapshot_every", SNAPSHOT_EVERY)
+    sync_interval = config.get("journal_sync_interval", SYNC_INTERVAL)
+    return QueueJournal(directory, snapshot_every=int(snapshot_every),
+                        sync_interval=float(sync_interval))
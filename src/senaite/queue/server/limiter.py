@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+import time
+from collections import deque
+
+# Number of tasks the queue allows to be processed at the same time on start
+INITIAL_LIMIT = 4
+
+# Factor the limit is multiplied by when a task fails
+FAIL_BACKOFF = 0.5
+
+# Factor the limit is multiplied by when a task takes much longer than usual
+LATENCY_BACKOFF = 0.9
+
+# A task takes much longer than usual when its latency is above the average
+# latency multiplied by this factor
+LATENCY_FACTOR = 2.0
+
+# Weight of the latency of the last task in the average latency
+LATENCY_WEIGHT = 0.1
+
+# Min number of seconds between two consecutive decreases of the limit, so a
+# burst of failures caused by the same congestion only decreases the limit once
+COOLDOWN = 5
+
+# Max number of changes of the limit to keep track of
+MAX_HISTORY = 100
+
+
+class ConcurrencyLimiter(object):
+    """Keeps the number of tasks the queue allows to be processed at the same
+    time with an additive-increase/multiplicative-decrease (AIMD) controller.
+    The limit increases while tasks are processed successfully and within the
+    usual time, and decreases when tasks fail (e.g. transaction conflicts) or
+    take much longer than usual. The limit grows by one on each task done
+    until the first decrease (slow start) and by one per limit tasks done
+    afterwards
+    """
+
+    def __init__(self, get_bounds, limit=INITIAL_LIMIT):
+        """
+        :param get_bounds: function that returns a tuple (min, max) with the
+            bounds of the limit
+        :param limit: initial limit
+        """
+        self._get_bounds = get_bounds
+        self._limit = float(limit)
+        self._latency = None
+        self._congested = False
+        self._last_decrease = 0
+        self._history = deque(maxlen=MAX_HISTORY)
+        self._lock = threading.Lock()
+
+    def get_limit(self):
+        """Returns the current limit, within the bounds
+        :rtype: int
+        """
+        min_limit, max_limit = self._get_bounds()
+        limit = int(self._limit)
+        return max(min_limit, min(max_limit, limit))
+
+    def get_latency(self):
+        """Returns the average number of seconds tasks take to be processed,
+        or None if no task has been processed yet
+        """
+        return self._latency
+
+    def get_history(self):
+        """Returns the changes of the limit, oldest first, as dicts with the
+        time of the change, the new limit and the reason of the change
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._history)
+
+    def on_done(self, latency):
+        """Notifies the limiter that a task has been processed successfully
+        :param latency: number of seconds the task took to be processed
+        """
+        with self._lock:
+            average = self._latency
+            if average is None:
+                self._latency = latency
+            else:
+                self._latency = (LATENCY_WEIGHT * latency +
+                                 (1 - LATENCY_WEIGHT) * average)
+
+            if average and latency > average * LATENCY_FACTOR:
+                # The task took much longer than usual
+                self._decrease(LATENCY_BACKOFF, "latency")
+                return
+
+            limit = self.get_limit()
+            if self._congested:
+                self._set_limit(self._limit + 1.0 / limit, "done")
+            else:
+                self._set_limit(self._limit + 1, "done")
+
+    def on_fail(self):
+        """Notifies the limiter that the processing of a task failed
+        """
+        with self._lock:
+            self._decrease(FAIL_BACKOFF, "fail")
+
+    def _decrease(self, factor, reason):
+        """Multiplies the limit by the factor passed-in, unless the limit has
+        been decreased recently already
+        """
+        now = time.time()
+        if self._last_decrease + COOLDOWN > now:
+            return
+        self._last_decrease = now
+        self._congested = True
+        self._set_limit(self.get_limit() * factor, reason)
+
+    def _set_limit(self, limit, reason):
+        """Sets the limit, within the bounds, and keeps track of the change
+        """
+        min_limit, max_limit = self._get_bounds()
+        previous = self.get_limit()
+        self._limit = max(min_limit, min(max_limit, limit))
+        if self.get_limit() != previous:
+            self._history.append(self._get_change(reason))
+
+    def _get_change(self, reason):
+        return {
+            "time": time.time(),
+            "limit": self.get_limit(),
+            "reason": reason,
+        }
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Prefix of the names of the metrics in Prometheus format
+PREFIX = "senaite_queue_"
+
+# Metrics the queue server keeps track of, with their type and description
+METRICS = OrderedDict((
+    ("tasks_added", ("counter", "Tasks added to the queue")),
+    ("task_chunks", ("counter", "Tasks added to process the remaining items "
+                                "of a task in chunks")),
+    ("tasks_done", ("counter", "Tasks processed successfully")),
+    ("tasks_failed", ("counter", "Tasks whose processing failed")),
+    ("tasks_timeout", ("counter", "Tasks whose processing timed out")),
+    ("tasks_retried", ("counter", "Tasks re-queued after a failure")),
+    ("conflict_errors", ("counter", "Tasks failed because of a conflict error "
+                                    "in the database")),
+    ("conflict_retries", ("counter", "Conflict errors in the database resolved "
+                                     "by the consumer with a retry")),
+    ("wait_seconds", ("histogram", "Seconds tasks waited in the queue until "
+                                   "popped by a consumer")),
+    ("run_seconds", ("histogram", "Seconds tasks took to be processed")),
+    ("tasks", ("gauge", "Tasks in the queue")),
+    ("concurrency_limit", ("gauge", "Max number of tasks to be processed at "
+                                    "the same time")),
+))
+
+# Upper bounds of the buckets of histograms, in seconds. Bounds grow
+# exponentially, so the relative error is the same for short and long values
+BUCKETS = tuple([0.001 * 2 ** num for num in range(18)])
+
+
+class Histogram(object):
+    """Distribution of values in buckets with fixed bounds
+    """
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        # Last bucket is for the values above the highest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_buckets(self):
+        """Returns a list of tuples (upper bound, cumulative count)
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf", ), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets
+
+
+class MetricsRegistry(object):
+    """Keeps in memory the counters, gauges and histograms of the queue, by
+    metric and labels. Recording a value takes constant time
+    """
+
+    def __init__(self):
+        # Values by metric name and sorted tuple of labels
+        self._values = dict([(name, {}) for name in METRICS.keys()])
+        self._lock = threading.Lock()
+
+    def inc(self, metric, value=1, **labels):
+        """Increases the counter with the name and labels passed-in
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[metric]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, metric, value, **labels):
+        """Sets the value of the gauge with the name and labels passed-in
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[metric][key] = value
+
+    def observe(self, metric, value, **labels):
+        """Adds a value to the histogram with the name and labels passed-in
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[metric]
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram()
+            histogram.observe(max(value, 0))
+
+    def get(self, metric, **labels):
+        """Returns the value of the counter or gauge with the name and labels
+        passed-in, or the number of values of the histogram
+        """
+        key = tuple(sorted(labels.items()))
+        value = self._values[metric].get(key, 0)
+        if isinstance(value, Histogram):
+            return value.count
+        return value
+
+    def to_list(self):
+        """Returns a list of dicts, one for each metric, with the type, the
+        description and the values of the metric by labels
+        """
+        metrics = []
+        with self._lock:
+            for name, (metric_type, help_text) in METRICS.items():
+                values = []
+                for key, value in sorted(self._values[name].items()):
+                    item = {"labels": dict(key)}
+                    if isinstance(value, Histogram):
+                        item.update({
+                            "count": value.count,
+                            "sum": value.sum,
+                            "buckets": value.get_buckets(),
+                        })
+                    else:
+                        item["value"] = value
+                    values.append(item)
+
+                metrics.append({
+                    "name": name,
+                    "type": metric_type,
+                    "help": help_text,
+                    "values": values,
+                })
+        return metrics
+
+    def to_prometheus(self):
+        """Returns the metrics in Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.to_list():
+            name = PREFIX + metric["name"]
+            if metric["type"] == "counter":
+                name = "{}_total".format(name)
+            lines.append("# HELP {} {}".format(name, metric["help"]))
+            lines.append("# TYPE {} {}".format(name, metric["type"]))
+
+            for item in metric["values"]:
+                labels = item["labels"]
+                if metric["type"] != "histogram":
+                    lines.append(get_sample(name, labels, item["value"]))
+                    continue
+
+                for bound, count in item["buckets"]:
+                    bucket_labels = dict(labels, le=bound)
+                    bucket_name = "{}_bucket".format(name)
+                    lines.append(get_sample(bucket_name, bucket_labels, count))
+                lines.append(get_sample(name + "_sum", labels, item["sum"]))
+                lines.append(get_sample(name + "_count", labels, item["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+def get_sample(name, labels, value):
+    """Returns a line with the sample of a metric in Prometheus format
+    """
+    def escape(label_value):
+        label_value = str(label_value or "")
+        label_value = label_value.replace("\\", "\\\\")
+        label_value = label_value.replace("\n", "\\n")
+        return label_value.replace('"', '\\"')
+
+    labels = map(lambda item: '{}="{}"'.format(item[0], escape(item[1])),
+                 sorted(labels.items()))
+    labels = labels and "{{{}}}".format(",".join(labels)) or ""
+    return "{}{} {}".format(name, labels, repr(float(value)))
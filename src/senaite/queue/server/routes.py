@@ -18,11 +18,11 @@
 # Copyright 2019-2021 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
+import transaction
 from senaite.jsonapi import request as req
 from senaite.jsonapi.v1 import add_route
 from senaite.queue import api as qapi
 from senaite.queue import logger
-from senaite.queue.queue import get_max_retries
 from senaite.queue.queue import get_task_uid
 from senaite.queue.queue import is_task
 from senaite.queue.queue import to_task
@@ -36,6 +36,9 @@ from senaite.queue.request import handle_queue_errors
 
 from bika.lims import api
 
+# Maximum number of seconds a request can wait for changes in the queue
+MAX_WAIT = 25
+
 
 def check_server(func):
     """Decorator that checks the current client is configured to act as server
@@ -54,34 +57,68 @@ def check_server(func):
 @check_server
 @handle_queue_errors
 def tasks(context, request, status=None):  # noqa
-    """Returns a JSON representation of the tasks from the queue
+    """Returns a JSON representation of the tasks from the queue. Tasks can be
+    filtered by "name" and "username", sorted with "sort_on" and "sort_order"
+    and paginated with "offset" and "limit". The response includes the total
+    number of tasks that match with the criteria and, if "complete", the
+    position of each task in the queue
     """
     # Maybe the status has been sent via POST
     request_data = req.get_json()
     status = status or request_data.get("status", [])
-    since = request_data.get("since", 0)
-
-    # Get the tasks
-    items = qapi.get_queue().get_tasks(status)
-
-    # Skip ghosts unless explicitly asked
-    if "ghost" not in status:
-        items = filter(lambda t: not t.get("ghost"), items)
-
-    # Skip older
-    items = filter(lambda t: t.created > since, items)
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+
+    # Get the page of tasks
+    items, total = qapi.get_queue().get_tasks_page(
+        status=status,
+        name=request_data.get("name"),
+        username=request_data.get("username"),
+        since=request_data.get("since"),
+        sort_on=request_data.get("sort_on"),
+        sort_order=request_data.get("sort_order"),
+        offset=request_data.get("offset"),
+        limit=request_data.get("limit"))
 
     # Convert to the dict representation
     complete = request_data.get("complete") or False
-    summary = get_tasks_summary(list(items), "server.tasks", complete=complete)
+    summary = get_tasks_summary(items, "server.tasks", complete=complete)
 
-    # Update the summary with the created time of oldest task
+    # Update the summary with the total number of tasks that match with the
+    # criteria and the created time of oldest task
     summary.update({
+        "total": total,
         "since_time": qapi.get_queue().get_since_time()
     })
     return summary
 
 
+@add_route("/queue_server/concurrency",
+           "senaite.queue.server.concurrency", methods=["GET", "POST"])
+@check_server
+@handle_queue_errors
+def concurrency(context, request):  # noqa
+    """Returns the max number of tasks the queue allows to be processed at the
+    same time, its bounds and the history of changes
+    """
+    info = qapi.get_queue().get_concurrency()
+    history = info.pop("history")
+    return get_list_summary(history, "server.concurrency", **info)
+
+
+@add_route("/queue_server/metrics",
+           "senaite.queue.server.metrics", methods=["GET", "POST"])
+@check_server
+@handle_queue_errors
+def metrics(context, request):  # noqa
+    """Returns the counters and histograms of the events of the queue, by
+    task name and consumer. The same metrics are available in Prometheus text
+    format at the view "queue_metrics"
+    """
+    items = qapi.get_queue().get_metrics().to_list()
+    return get_list_summary(items, "server.metrics")
+
+
 @add_route("/queue_server/diff",
            "senaite.queue.server.diff", methods=["GET", "POST"])
 @check_server
@@ -96,8 +133,9 @@ def diff(context, request):
     items = qapi.get_queue().get_tasks(status)
 
     # Keep track of the uids the client has to remove
-    server_uids = map(lambda t: t.task_uid, items)
+    server_uids = set(map(lambda t: t.task_uid, items))
     stale_uids = filter(lambda uid: uid not in server_uids, client_uids)
+    client_uids = set(client_uids)
 
     def keep(task):
         # Skip ghosts unless explicitly asked
@@ -129,6 +167,70 @@ def diff(context, request):
     return summary
 
 
+@add_route("/queue_server/changes",
+           "senaite.queue.server.changes", methods=["GET", "POST"])
+@check_server
+@handle_queue_errors
+def changes(context, request):  # noqa
+    """Returns the tasks that have been added or changed and the uids of the
+    tasks that have been removed since the version of the queue the client
+    knows. If the server does not know the changes since that version, all
+    tasks are returned and "resync" is set to True.
+
+    If "wait" is set, the request is held until the queue changes or the
+    given number of seconds expire (long-polling)
+    """
+    request_data = req.get_json()
+    status = request_data.get("status") or ["queued", "running"]
+    version = request_data.get("version")
+    epoch = request_data.get("epoch")
+    wait = api.to_int(request_data.get("wait"), default=0)
+    queue = qapi.get_queue()
+
+    if wait > 0 and version is not None:
+        # Wait until the queue changes since the version known by the client
+        timeout = min(wait, MAX_WAIT)
+        queue.wait_for_changes(version, epoch=epoch, timeout=timeout)
+
+    def keep(task):
+        # Skip ghosts unless explicitly asked
+        if task.get("ghost") and "ghost" not in status:
+            return False
+        return task.status in status
+
+    # Get the changes since the version known by the client
+    data = queue.get_changes(version, epoch=epoch)
+    if data is None:
+        # Full resync. Get the version first, so the changes done while the
+        # tasks are retrieved are sent again on next request
+        epoch, version = queue.get_version()
+        items = filter(keep, queue.get_tasks(status))
+        removed = []
+        resync = True
+    else:
+        epoch = data["epoch"]
+        version = data["version"]
+        items = filter(keep, data["tasks"])
+
+        # Tasks that do not match with the criteria have to be removed too
+        kept = set(map(lambda t: t.task_uid, items))
+        discarded = map(lambda t: t.task_uid, data["tasks"])
+        discarded = filter(lambda uid: uid not in kept, discarded)
+        removed = data["removed"] + discarded
+        resync = False
+
+    # Convert to the dict representation
+    complete = request_data.get("complete") or False
+    summary = get_tasks_summary(items, "server.changes", complete=complete)
+    summary.update({
+        "epoch": epoch,
+        "version": version,
+        "removed": removed,
+        "resync": resync,
+    })
+    return summary
+
+
 @add_route("/queue_server/uids",
            "senaite.queue.server.uids", methods=["GET", "POST"])
 @add_route("/queue_server/uids/<string:status>",
@@ -203,11 +305,20 @@ def add(context, request):  # noqa
     if not all(valid):
         _fail(406, "No valid task(s)")
 
-    # Add the task(s) to the queue
-    map(qapi.get_queue().add, items)
+    # Add the task(s) to the queue. Tasks that cannot be added (e.g. a task
+    # for same context and name is in the queue already) are skipped
+    queue = qapi.get_queue()
+    added = filter(None, map(queue.add, items))
 
-    # Return the process summary
-    return get_tasks_summary(items, "server.add", complete=False)
+    # Tasks are added to the queue on commit, when the queue might have
+    # changed already. Commit now, so only the tasks added are accepted
+    transaction.commit()
+    added = filter(queue.has_task, added)
+    accepted = map(lambda t: t.task_uid, added)
+
+    # Return the process summary, with the uids of the tasks added
+    return get_tasks_summary(items, "server.add", complete=False,
+                             accepted=accepted)
 
 
 @add_route("/queue_server/pop", "senaite.queue.server.pop", methods=["POST"])
@@ -231,6 +342,51 @@ def pop(context, request):  # noqa
     return get_task_info(task, complete=True)
 
 
+@add_route("/queue_server/pop_many", "senaite.queue.server.pop_many",
+           methods=["POST"])
+@check_server
+@handle_queue_errors
+def pop_many(context, request):  # noqa
+    """Pops up to max_tasks tasks from the queue at once, if any. The tasks
+    are meant to be processed one after the other by the same consumer
+    """
+    # Get the consumer ID
+    request_data = req.get_json()
+    consumer_id = request_data.get("consumer_id")
+    if not is_consumer_id(consumer_id):
+        _fail(428, "No valid consumer id")
+
+    # Get the max number of tasks to pop
+    max_tasks = api.to_int(request_data.get("max_tasks"), default=0)
+    if max_tasks < 1:
+        _fail(412, "No valid max number of tasks")
+
+    # Pop the tasks from the queue
+    items = qapi.get_queue().pop_many(consumer_id, max_tasks)
+
+    # Return the process summary
+    return get_tasks_summary(items, "server.pop_many", complete=True)
+
+
+@add_route("/queue_server/heartbeat", "senaite.queue.server.heartbeat",
+           methods=["POST"])
+@check_server
+@handle_queue_errors
+def heartbeat(context, request):  # noqa
+    """Renews the lease of the running tasks of the consumer, so they are not
+    re-queued while the consumer is processing them. Returns the uids of the
+    tasks the consumer holds the lease of
+    """
+    # Get the consumer ID
+    consumer_id = req.get_json().get("consumer_id")
+    if not is_consumer_id(consumer_id):
+        _fail(428, "No valid consumer id")
+
+    # Renew the lease
+    task_uids = qapi.get_queue().heartbeat(consumer_id)
+    return get_list_summary(task_uids, "server.heartbeat")
+
+
 @add_route("/queue_server/done", "senaite.queue.server.done", methods=["POST"])
 @check_server
 @handle_queue_errors
@@ -273,9 +429,11 @@ def fail(context, request):  # noqa
         _fail(412, "Task is not running")
 
     # Notify the queue
-    qapi.get_queue().fail(task, error_message=error_message)
+    queue = qapi.get_queue()
+    queue.fail(task, error_message=error_message)
 
-    # Return the process summary
+    # Return the process summary, with the task either re-queued or failed
+    task = queue.get_task(task_uid) or task
     msg = "Task failed: {}".format(task_uid)
     task_info = {"task": get_task_info(task)}
     return get_message_summary(msg, "server.fail", **task_info)
@@ -298,13 +456,46 @@ def timeout(context, request):  # noqa
         _fail(412, "Task is not running")
 
     # Notify the queue
-    qapi.get_queue().timeout(task)
+    queue = qapi.get_queue()
+    queue.timeout(task)
 
-    # Return the process summary
+    # Return the process summary, with the task either re-queued or failed
+    task = queue.get_task(task_uid) or task
     task_info = {"task": get_task_info(task)}
     return get_message_summary(task_uid, "server.timeout", **task_info)
 
 
+@add_route("/queue_server/ack", "senaite.queue.server.ack", methods=["POST"])
+@check_server
+@handle_queue_errors
+def ack(context, request):  # noqa
+    """Acknowledge the outcome of the processing of several tasks at once.
+    Tasks done are removed, while tasks that failed or timed out are either
+    re-queued or moved to failed. Tasks that are not running are skipped
+    """
+    request_data = req.get_json()
+    done = filter(api.is_uid, request_data.get("done") or [])
+    timeout = filter(api.is_uid, request_data.get("timeout") or [])
+    failed = request_data.get("failed") or {}
+    if not isinstance(failed, dict):
+        _fail(412, "No valid failed tasks")
+    failed = dict(filter(lambda f: api.is_uid(f[0]), failed.items()))
+    conflicts = request_data.get("conflicts") or {}
+    if not isinstance(conflicts, dict):
+        _fail(412, "No valid conflicts")
+    conflicts = dict(filter(lambda c: api.is_uid(c[0]), conflicts.items()))
+    consumer_id = request_data.get("consumer_id")
+
+    # Notify the queue
+    queue = qapi.get_queue()
+    acked = queue.ack(done=done, failed=failed, timeout=timeout,
+                      conflicts=conflicts, consumer_id=consumer_id)
+
+    # Return the process summary, with the tasks either re-queued or failed
+    items = filter(None, map(queue.get_task, acked))
+    return get_tasks_summary(items, "server.ack", complete=True, acked=acked)
+
+
 @add_route("/queue_server/requeue",
            "senaite.queue.server.requeue", methods=["POST"])
 @add_route("/queue_server/requeue/<string(length=32):task_uid>",
@@ -318,14 +509,10 @@ def requeue(context, request, task_uid=None):  # noqa
     # Maybe the task uid has been sent via POST
     task_uid = task_uid or req.get_json().get("task_uid")
 
-    # Get the task
+    # Re-queue the task, with the max number of retries restored, when the
+    # transaction is committed
     task = get_task(task_uid)
-
-    # Remove, restore max number of retries and re-add the task
-    task.retries = get_max_retries()
-    queue = qapi.get_queue()
-    queue.delete(task_uid)
-    queue.add(task)
+    task = qapi.get_queue().requeue(task)
 
     # Return the process summary
     msg = "Task re-queued: {}".format(task_uid)
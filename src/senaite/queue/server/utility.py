@@ -18,22 +18,44 @@
 # Copyright 2019-2021 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import copy
-
+import heapq
+import itertools
 import math
 import threading
 import time
+from collections import Counter
+from collections import deque
 from senaite.queue import logger
+from senaite.queue.datamanager import discard_pending_tasks
+from senaite.queue.datamanager import get_data_manager
+from senaite.queue.datamanager import get_pending_tasks
 from senaite.queue.interfaces import IServerQueueUtility
+from senaite.queue.lock import ReadWriteLock
+from senaite.queue.queue import get_concurrency_bounds
+from senaite.queue.queue import get_consumer_host
+from senaite.queue.queue import get_consumer_workers
+from senaite.queue.queue import get_lease_expiry
+from senaite.queue.queue import get_long_poll_clients
+from senaite.queue.queue import get_max_retries
 from senaite.queue.queue import get_task_uid
+from senaite.queue.queue import get_tasks_page
+from senaite.queue.queue import is_conflict_error
 from senaite.queue.queue import is_task
+from senaite.queue.queue import to_task
+from senaite.queue.server.journal import get_journal
+from senaite.queue.server.limiter import ConcurrencyLimiter
+from senaite.queue.server.metrics import MetricsRegistry
 from zope.interface import implements  # noqa
 
 from bika.lims import api as capi
 from bika.lims import APIError
+from bika.lims.utils import tmpID
+
+# Pools of tasks the queue keeps track of
+TASK_POOLS = ["queued", "running", "failed", "ghost"]
 
-# Maximum number of concurrent tasks to be processed at a time
-MAX_CONCURRENT_TASKS = 4
+# Maximum number of changes to keep track of for clients synchronization
+MAX_CHANGES = 10000
 
 
 class ServerQueueUtility(object):
@@ -43,9 +65,85 @@ class ServerQueueUtility(object):
     implements(IServerQueueUtility)
 
     def __init__(self):
-        self._tasks = []
+        # Tasks of the queue, keyed by task_uid
+        self._tasks = {}
         self._since_time = -1
-        self.__lock = threading.Lock()
+        self.__lock = ReadWriteLock()
+
+        # Priority queue (binary heap) of queued tasks. Each entry is a tuple
+        # (sort_key, seq, task). Entries are never removed from the heap but
+        # on pop: the entry is only valid while its seq matches with the one
+        # stored in self._heap_seqs for the same task
+        self._heap = []
+        self._heap_seqs = {}
+        self._heap_counter = itertools.count()
+
+        # Sort keys of tasks, computed once when the task is (re)queued, and
+        # the top-priority tasks setting they were computed with
+        self._sort_keys = {}
+        self._top_priority = None
+
+        # Heap entries of the queued tasks that cannot be popped yet, so they
+        # are not checked again on every pop. Delayed tasks are kept in a heap
+        # of tuples (ready time, seq, entry) until the delay expires. Tasks
+        # blocked by running tasks with same name and path are kept by (name,
+        # path) until none of the running tasks have that name or path, with
+        # the paths of blocked tasks by name and the names by path
+        self._delayed = []
+        self._blocked = {}
+        self._blocked_names = {}
+        self._blocked_paths = {}
+
+        # Index of uids (context_uid plus uids) referenced by tasks, with the
+        # task_uids of the tasks that refer to them as values
+        self._uids_index = {}
+
+        # Pools of tasks by status, with the task_uids as keys. Ghost tasks are
+        # stored in their status pool as well, but also in the "ghost" pool
+        self._pools = dict([(status, {}) for status in TASK_POOLS])
+
+        # task_uids of the running tasks, grouped by consumer
+        self._consumers = {}
+
+        # Expiry time of the lease of the consumers with running tasks. The
+        # running tasks of a consumer are re-queued if the lease expires
+        self._leases = {}
+
+        # Number of running tasks by task name and by (stripped) context path
+        self._running_names = Counter()
+        self._running_paths = Counter()
+
+        # Number of consumers (worker threads) with running tasks by consumer
+        # host (zeo client)
+        self._running_hosts = Counter()
+
+        # Whether the since time has to be re-computed
+        self._since_time_outdated = False
+
+        # Version of the queue, that is increased on every change. The epoch
+        # identifies the life-cycle of this utility, versions from a previous
+        # life-cycle (e.g. before a restart) are not valid anymore
+        self._epoch = tmpID()
+        self._version = 0
+
+        # Ring buffer of changes, as tuples (version, task_uid)
+        self._changes = deque(maxlen=MAX_CHANGES)
+
+        # Condition notified on every change, with the number of threads that
+        # are waiting for changes
+        self._changed = threading.Condition(threading.Lock())
+        self._waiters = 0
+
+        # Max number of tasks to be processed at a time, adapted to the
+        # latency and failures of the tasks processed
+        self._limiter = ConcurrencyLimiter(get_concurrency_bounds)
+
+        # Counters and histograms of the events of the queue
+        self._metrics = MetricsRegistry()
+
+        # Journal where the events are stored for recovery, if configured
+        self._journal = get_journal()
+        self._recovered = self._journal is None
 
     # TODO REMOVE (no longer required)
     def get_since_time(self):
@@ -53,14 +151,43 @@ class ServerQueueUtility(object):
         was created, failed tasks excluded. Returns -1 if queue has no queued
         or running tasks
         """
+        if self._since_time_outdated:
+            with self.__lock.read():
+                active = self.get_pool("queued").values()
+                active.extend(self.get_pool("running").values())
+                created = map(lambda t: t.created, active)
+                self._since_time = created and min(created) or -1
+                self._since_time_outdated = False
         return self._since_time
 
     def add(self, task):
-        """Adds a task to the queue
+        """Adds a task to the queue. The task is added when the current
+        transaction is committed, together with the rest of tasks added during
+        the transaction, and is discarded if the transaction is aborted. In the
+        meantime, the task is only visible from within the transaction
         :param task: the QueueTask to add
+        :return: the added QueueTask object
+        :rtype: queue.QueueTask
+        """
+        # Only QueueTask type is supported
+        if not is_task(task):
+            raise ValueError("{} is not supported".format(repr(task)))
+
+        if not self._can_add(task):
+            return None
+
+        # Add the task to the queue on commit. The task passed-in is not
+        # modified, so frozen tasks (e.g. re-queued ones) can be added too
+        task = task.copy_with(_frozen=True, status="queued")
+        get_data_manager(self._flush).add(task)
+        return task
+
+    def _flush(self, tasks):
+        """Adds the tasks passed-in to the queue
+        :param tasks: list of QueueTask objects to add
         """
-        with self.__lock:
-            return self._add(task)
+        with self.__lock.write():
+            map(self._add, tasks)
 
     def pop(self, consumer_id):
         """Returns the next task to process, if any
@@ -68,66 +195,91 @@ class ServerQueueUtility(object):
         :return: the task to be processed or None
         :rtype: queue.QueueTask
         """
-        with self.__lock:
-            # Get the queued tasks
-            queued = filter(lambda t: t.status == "queued", self._tasks)
-            if not queued:
-                # Maybe some tasks got stuck
-                self._purge()
-
-            consumer_tasks = self._get_consumer_tasks(consumer_id)
-            if consumer_tasks:
-                # This consumer has tasks running already, mark those that have
-                # been running for more than 10s as failed. We assume here the
-                # consumer always checks there is no thread running from his
-                # side before doing a pop(). Thus, we consider that when a
-                # consumer does a pop(), he did not succeed with running ones.
-                for consumer_task in consumer_tasks:
-                    started = consumer_task.get("started")
-                    if not started or started + 10 < time.time():
-                        msg = "Purged on pop ({})".format(consumer_id)
-                        self._fail(consumer_task, error_message=msg)
-                return None
+        tasks = self.pop_many(consumer_id, 1)
+        return tasks and tasks[0] or None
+
+    def pop_many(self, consumer_id, max_tasks):
+        """Returns up to max_tasks tasks to process, if any. The tasks are
+        meant to be processed one after the other by the same consumer
+        :param consumer_id: id of the consumer thread that will process the
+            tasks
+        :param max_tasks: max number of tasks to return
+        :return: list of tasks to be processed
+        :rtype: list
+        """
+        with self.__lock.write():
+            # Re-queue the tasks from consumers whose lease expired
+            self._purge()
+
+            if self._consumers.get(consumer_id):
+                # This consumer has tasks running already. The consumer might
+                # be processing them still, so wait until they are done or
+                # until the lease expires because the consumer did not renew
+                return []
+
+            # Each worker of a consumer has its own consumer id, but no more
+            # workers than configured can be running tasks at a time
+            host = get_consumer_host(consumer_id)
+            if self._running_hosts[host] >= get_consumer_workers():
+                return []
 
             if self.is_busy():
                 # We've reached the max number of tasks to process at same time
-                return None
+                return []
+
+            # Sort the queued tasks again if top-priority tasks changed
+            top_priority = list(self.get_top_priority_tasks() or [])
+            if top_priority != self._top_priority:
+                self._top_priority = top_priority
+                self._rebuild_queued()
 
-            # Get the names and paths of tasks that are currently running
-            running_names = self.get_running_task_names()
-            running_paths = self.get_running_context_paths()
+            tasks = []
+            started = time.time()
+            while len(tasks) < max_tasks:
+                # Get the task with the highest priority that can be processed
+                task = self._pop_queued()
+                if not task:
+                    break
 
-            # Tasks are sorted from highest to lowest priority
-            for task in queued:
-                # Wait some secs before a task is available for pop. We do not
-                # want to start processing the task while the life-cycle of the
-                # request that added the task is still alive
+                # Update the task
+                task = self._set_status(task, "running", started=started,
+                                        consumer_id=consumer_id)
+                self._record("pop", task)
+                tasks.append(task)
+
+                # Time the task waited since it was (re)queued
                 delay = capi.to_int(task.get("delay"), default=0)
-                if task.created + delay > time.time():
-                    continue
+                self._metrics.observe("wait_seconds",
+                                      started - task.created - delay,
+                                      name=task.name)
 
-                # Be sure there is no other consumer working in a same type of
-                # task and for the same path
-                if task.name in running_names:
-                    # There is another consumer processing a task of same type
-                    if self.strip_path(task.context_path) in running_paths:
-                        # Same path, skip
-                        continue
-
-                # Update and return the task
-                task.update({
-                    "started": time.time(),
-                    "status": "running",
-                    "consumer_id": consumer_id,
-                })
-                return copy.deepcopy(task)
-            return None
+            if tasks:
+                # The consumer takes the lease of the tasks
+                self._leases[consumer_id] = get_lease_expiry()
+
+            return tasks
+
+    def heartbeat(self, consumer_id):
+        """Renews the lease of the running tasks of the consumer passed-in, so
+        they are not re-queued while the consumer is processing them
+        :param consumer_id: id of the consumer thread that is processing tasks
+        :return: list of the task uids the consumer holds the lease of
+        :rtype: list
+        """
+        with self.__lock.write():
+            task_uids = list(self._consumers.get(consumer_id) or [])
+            if task_uids:
+                self._leases[consumer_id] = get_lease_expiry()
+            return task_uids
 
     def done(self, task):
         """Notifies the queue that the task has been processed successfully
         :param task: task's unique id (task_uid) or QueueTask object
         """
-        self.delete(task)
+        with self.__lock.write():
+            task_uid = get_task_uid(task)
+            self._done(self.get_pool("running").get(task_uid))
+            self._delete(task_uid, event="done")
 
     def fail(self, task, error_message=None):
         """Notifies the queue that the processing of the task failed. Removes
@@ -136,16 +288,16 @@ class ServerQueueUtility(object):
         :param task: task's unique id (task_uid) or QueueTask object
         :param error_message: (Optional) the error/traceback
         """
-        with self.__lock:
+        with self.__lock.write():
             # We do this dance because the task passed in is probably a copy,
-            # but self._fail expects a reference to self._tasks
+            # but self._fail expects the task stored in self._tasks
             task_uid = get_task_uid(task)
-            task = filter(lambda t: t.task_uid == task_uid, self._tasks)
+            task = self._tasks.get(task_uid)
             if not task:
                 raise ValueError("Task is not in the queue")
 
             # Label the task as failed
-            self._fail(task[0], error_message=error_message)
+            self._fail(task, error_message=error_message)
 
     def timeout(self, task):
         """Notifies the queue that the processing of the task timed out.
@@ -154,51 +306,190 @@ class ServerQueueUtility(object):
         eventually re-queued. Is added to the pool of failed otherwise
         :param task: task's unique id (task_uid) or QueueTask object
         """
-        with self.__lock:
+        with self.__lock.write():
             # We do this dance because the task passed in is probably a copy,
-            # but self._timeout expects a reference to self._tasks
+            # but self._timeout expects the task stored in self._tasks
             task_uid = get_task_uid(task)
-            task = filter(lambda t: t.task_uid == task_uid, self._tasks)
+            task = self._tasks.get(task_uid)
             if not task:
                 raise ValueError("Task is not in the queue")
 
             # Mark the task as failed by timeout
-            self._timeout(task[0])
+            self._timeout(task)
+
+    def ack(self, done=None, failed=None, timeout=None, conflicts=None,
+            consumer_id=None):
+        """Notifies the queue about the outcome of the processing of several
+        tasks at once. Tasks that are not running are skipped
+        :param done: list of task uids processed successfully
+        :param failed: dict of task uids whose processing failed, with the
+            error/traceback as values
+        :param timeout: list of task uids whose processing timed out
+        :param conflicts: dict of task uids with the number of conflict
+            errors the consumer came across while processing them
+        :param consumer_id: (Optional) id of the consumer that processed the
+            tasks. If set, the tasks running for other consumers are skipped
+        :return: list of the task uids acknowledged by the queue
+        :rtype: list
+        """
+        failed = failed or {}
+        with self.__lock.write():
+            def get_running(task_uid):
+                task = self.get_pool("running").get(task_uid)
+                if task and consumer_id:
+                    # The task might be running for another consumer (e.g.
+                    # an acknowledgment sent twice after the lease expired)
+                    if task.get("consumer_id") != consumer_id:
+                        return None
+                return task
+
+            done = filter(None, map(get_running, done or []))
+            failed = dict(filter(lambda f: get_running(f[0]), failed.items()))
+            timeout = filter(None, map(get_running, timeout or []))
+
+            # Conflicts retried by the consumer, regardless of the outcome
+            for task_uid, num in (conflicts or {}).items():
+                task = get_running(task_uid)
+                if task and num > 0:
+                    labels = {"name": task.name,
+                              "consumer": task.get("consumer_id")}
+                    self._metrics.inc("conflict_retries", num, **labels)
+
+            # The tasks were processed one after the other
+            batch_size = len(done) + len(failed) + len(timeout)
+
+            acked = []
+            for task in done:
+                self._done(task, batch_size=batch_size)
+                self._delete(task.task_uid, event="done")
+                acked.append(task.task_uid)
+
+            for task in filter(None, map(get_running, failed.keys())):
+                self._fail(task, error_message=failed[task.task_uid])
+                acked.append(task.task_uid)
+
+            for task in timeout:
+                self._timeout(task)
+                acked.append(task.task_uid)
+
+            return acked
 
     def delete(self, task):
         """Removes a task from the queue
         :param task: task's unique id (task_uid) or QueueTask object
         """
-        with self.__lock:
-            task_uid = get_task_uid(task)
+        task_uid = get_task_uid(task)
+
+        # The task might not have been added to the queue yet
+        discard_pending_tasks(self._flush, [task_uid])
+
+        with self.__lock.write():
             self._delete(task_uid)
 
+    def requeue(self, task):
+        """Re-queues the task with the max number of retries restored. The
+        task is removed and added again at once when the current transaction
+        is committed, and is kept as it is if the transaction is aborted
+        :param task: task's unique id (task_uid) or QueueTask object
+        :return: the task to be re-queued or None if not found
+        :rtype: queue.QueueTask
+        """
+        task = self.get_task(get_task_uid(task))
+        if not task:
+            return None
+        task = task.copy_with(_frozen=True, status="queued",
+                              retries=get_max_retries())
+        get_data_manager(self._flush_requeue).add(task)
+        return task
+
+    def _flush_requeue(self, tasks):
+        """Replaces the tasks from the queue by the tasks passed-in
+        :param tasks: list of QueueTask objects to re-queue
+        """
+        with self.__lock.write():
+            for task in tasks:
+                if task.task_uid not in self._tasks:
+                    # Removed in the meantime
+                    continue
+                self._delete(task.task_uid)
+                self._add(task)
+
     def get_task(self, task_uid):
-        """Returns the task with the given task uid
+        """Returns the task with the given task uid. The task is frozen
         :param task_uid: task's unique id
         :return: the task from the queue
         :rtype: queue.QueueTask
         """
         task_uid = get_task_uid(task_uid)
-        for task in self._tasks:
-            if task.task_uid == task_uid:
-                return copy.deepcopy(task)
-        return None
+        task = self._tasks.get(task_uid)
+        if task is None:
+            # Maybe the task is pending to be added in current transaction
+            pending = self._get_pending_tasks()
+            task = filter(lambda t: t.task_uid == task_uid, pending)
+            task = task and task[0] or None
+        return task
 
     def get_tasks(self, status=None):
-        """Returns a deep copy list with the tasks from the queue
+        """Returns a list with the tasks from the queue. Tasks are frozen
         :param status: (Optional) a string or list with status. If None, only
             "running" and "queued" are considered
         :return list of QueueTask objects
         :rtype: list
         """
+        with self.__lock.read():
+            tasks = self._get_tasks(status)
+
+        # Sort by priority + created
+        return sorted(tasks, key=self.get_sort_key)
+
+    def get_tasks_page(self, status=None, name=None, username=None,
+                       since=None, sort_on=None, sort_order=None, offset=0,
+                       limit=None):
+        """Returns a tuple (tasks, total) with the page of tasks with the
+        given status that match with the criteria passed-in, along with the
+        total number of tasks that match with the criteria. Ghost tasks are
+        only considered when "ghost" is one of the status passed-in
+        :param status: (Optional) a string or list with status. If None, only
+            "running" and "queued" are considered
+        :param name: (Optional) name of the tasks to look for
+        :param username: (Optional) username of the tasks to look for
+        :param since: (Optional) only tasks created after this time
+        :param sort_on: (Optional) attribute to sort the tasks by. Tasks are
+            sorted by their position in the queue by default
+        :param sort_order: (Optional) "ascending" (default) or "descending"
+        :param offset: (Optional) number of tasks to skip
+        :param limit: (Optional) max number of tasks to return
+        :return: tuple (list of QueueTask objects, total number of tasks)
+        """
+        if not isinstance(status, (list, tuple)):
+            status = [status]
+
+        with self.__lock.read():
+            tasks = self._get_tasks(status)
+
+        return get_tasks_page(tasks, self.get_sort_key, status=status,
+                              name=name, username=username, since=since,
+                              sort_on=sort_on, sort_order=sort_order,
+                              offset=offset, limit=limit)
+
+    def _get_tasks(self, status=None):
+        """Returns the unsorted list of tasks with the given status
+        """
         if not isinstance(status, (list, tuple)):
             status = [status]
         status = filter(None, status)
         status = status or ["running", "queued"]
-        tasks = filter(lambda t: t.status in status, self._tasks)
-        # We don't want self._tasks to be modified from outside!
-        return copy.deepcopy(tasks)
+
+        # Get the tasks from the pools. Ghost is not a status, but a flag
+        tasks = {}
+        for pool_id in filter(lambda st: st != "ghost", status):
+            tasks.update(self.get_pool(pool_id))
+        tasks = tasks.values()
+
+        # Include the tasks pending to be added in current transaction
+        if "queued" in status:
+            tasks.extend(self._get_pending_tasks())
+        return tasks
 
     def get_uids(self, status=None):
         """Returns a list with the uids from the queue
@@ -207,11 +498,23 @@ class ServerQueueUtility(object):
         :return list of uids
         :rtype: list
         """
-        out = set()
-        for task in self.get_tasks(status=status):
-            uids = [task.context_uid] + filter(None, task.uids)
-            out.update(uids)
-        return list(out)
+        return list(self.iter_uids(status=status))
+
+    def iter_uids(self, status=None):
+        """Returns an iterator over the uids from the queue, without duplicates
+        :param status: (Optional) a string or list with status. If None, only
+            "running" and "queued" are considered
+        """
+        # Tasks are frozen, so the list of tasks is a consistent snapshot
+        with self.__lock.read():
+            tasks = self._get_tasks(status)
+
+        seen = set()
+        for task in tasks:
+            for uid in self._get_referenced_uids(task):
+                if uid not in seen:
+                    seen.add(uid)
+                    yield uid
 
     def get_tasks_for(self, context_or_uid, name=None):
         """Returns a list with the queued or running tasks the queue contains
@@ -222,18 +525,29 @@ class ServerQueueUtility(object):
         :return: list of QueueTask objects
         :rtype: list
         """
+        return self._get_tasks_for(context_or_uid, name=name)
+
+    def _get_tasks_for(self, context_or_uid, name=None):
+        """Returns the list of tasks from the queue that refer to the given
+        context or uid, either as the context of the task or as one of the
+        uids of the task. Tasks are not copied
+        """
         try:
             uid = capi.get_uid(context_or_uid)
         except APIError:
             raise ValueError("{} is not supported".format(repr(context_or_uid)))
 
-        tasks = []
-        for task in self._tasks:
-            if name and task.name != name:
-                continue
-            if task.context_uid == uid or uid in task.uids:
-                tasks.append(copy.deepcopy(task))
-        return tasks
+        with self.__lock.read():
+            task_uids = self._uids_index.get(uid) or []
+            tasks = map(self._tasks.get, task_uids)
+
+        # Include the tasks pending to be added in current transaction
+        pending = self._get_pending_tasks()
+        tasks.extend(filter(lambda t: uid in self._get_referenced_uids(t),
+                            pending))
+        if name:
+            tasks = filter(lambda t: t.name == name, tasks)
+        return sorted(tasks, key=self.get_sort_key)
 
     def has_task(self, task):
         """Returns whether the queue contains a given task
@@ -249,23 +563,121 @@ class ServerQueueUtility(object):
         """Returns whether the queue contains a task for the given context and
         name if provided.
         """
-        tasks = self.get_tasks_for(context_or_uid, name=name)
+        tasks = self._get_tasks_for(context_or_uid, name=name)
         return any(tasks)
 
+    def get_version(self):
+        """Returns a tuple (epoch, version) that represents the current version
+        of the queue. The version is increased on every change of the queue
+        """
+        with self.__lock.read():
+            return self._epoch, self._version
+
+    def get_revision(self):
+        """Returns a value that changes whenever the tasks from the queue
+        change, tasks pending to be added in current transaction included.
+        Suitable as a key to cache the results of queries against the queue
+        """
+        pending = map(lambda t: t.task_uid, self._get_pending_tasks())
+        return self.get_version() + (tuple(pending), )
+
+    def get_changes(self, version, epoch=None):
+        """Returns the changes done in the queue since the version passed-in,
+        as a dict with the current "epoch" and "version", the "tasks" that
+        were added or changed and the task uids that were "removed". Returns
+        None if the changes since the given version are unknown, either
+        because the version is from another epoch or is too old
+        :param version: the version to get the changes since
+        :param epoch: the epoch the version belongs to
+        """
+        version = capi.to_int(version, default=-1)
+        with self.__lock.read():
+            if epoch != self._epoch or version < 0 or version > self._version:
+                return None
+
+            if self._changes and self._changes[0][0] > version + 1:
+                # The ring buffer rolled over, changes are lost
+                return None
+
+            # Walk the changes backwards until the version is reached
+            task_uids = set()
+            for change_version, task_uid in reversed(self._changes):
+                if change_version <= version:
+                    break
+                task_uids.add(task_uid)
+
+            tasks = []
+            removed = []
+            for task_uid in task_uids:
+                task = self._tasks.get(task_uid)
+                if task is None:
+                    removed.append(task_uid)
+                else:
+                    tasks.append(task)
+
+            return {
+                "epoch": self._epoch,
+                "version": self._version,
+                "tasks": tasks,
+                "removed": removed,
+            }
+
+    def wait_for_changes(self, version, epoch=None, timeout=20):
+        """Blocks the current thread until the queue changes after the version
+        passed-in or until the timeout expires. Does not block if the version
+        belongs to another epoch or if there are too many threads waiting
+        already
+        :param version: the version to wait for changes since
+        :param epoch: the epoch the version belongs to
+        :param timeout: maximum number of seconds to wait
+        :return: True if the queue changed after the given version
+        :rtype: bool
+        """
+        version = capi.to_int(version, default=-1)
+
+        # Each waiting request keeps a thread of the zeo client busy
+        max_waiters = get_long_poll_clients()
+
+        def is_changed():
+            return epoch != self._epoch or version != self._version
+
+        with self._changed:
+            if is_changed() or self._waiters >= max_waiters:
+                return is_changed()
+
+            self._waiters += 1
+            try:
+                expires = time.time() + timeout
+                while not is_changed():
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+            return is_changed()
+
+    def get_pool(self, status):
+        """Returns the pool of tasks for the given status, as a dict with the
+        task_uids as keys and the tasks as values. Tasks are not copied
+        :param status: "queued", "running", "failed" or "ghost"
+        """
+        return self._pools.get(status) or {}
+
     def _get_consumer_tasks(self, consumer_id):
         """Returns the tasks the consumer is currently processing
         :param consumer_id: unique id of the consumer
         """
-        running = filter(lambda t: t.status == "running", self._tasks)
-        return filter(lambda t: t.get("consumer_id") == consumer_id, running)
+        task_uids = self._consumers.get(consumer_id) or []
+        return map(self._tasks.get, task_uids)
 
     def get_running_context_paths(self):
         """Returns a list with the context paths of the tasks that are running.
         Levels 0 and 1 (site path and paths immediately below) are excluded
         """
-        tasks = filter(lambda t: t.status == "running", self._tasks)
-        paths = map(lambda t: self.strip_path(t.context_path), tasks)
-        return filter(None, paths)
+        with self.__lock.read():
+            return filter(None, self._running_paths.keys())
 
     def strip_path(self, context_path):
         """Strips levels 0 and 1 from the context path passed-in
@@ -276,24 +688,23 @@ class ServerQueueUtility(object):
     def get_running_task_names(self):
         """Returns a list with the names of the tasks that are running
         """
-        names = map(lambda t: t.name, self.get_tasks(status="running"))
-        return list(set(names))
+        with self.__lock.read():
+            return self._running_names.keys()
 
     def __len__(self):
-        with self.__lock:
-            # get_tasks returns a deepcopy. Is faster this way
-            status = ["queued", "running"]
-            return len(filter(lambda t: t.status in status, self._tasks))
+        with self.__lock.read():
+            queued = len(self.get_pool("queued"))
+            running = len(self.get_pool("running"))
+        pending = len(self._get_pending_tasks())
+        return queued + running + pending
 
     def update_since_time(self):
-        """Returns the created time since epoch from oldest task. If no tasks,
-        returns -1
+        """Flags the created time since epoch from oldest task as outdated, so
+        it is re-computed next time is requested
         """
-        # Update the since time (failed tasks are stored for traceability,
-        # but they are excluded from everywhere unless explicitly requested
-        active = filter(lambda t: t.status != "failed", self._tasks)
-        created = map(lambda t: t.created, active)
-        self._since_time = created and min(created) or -1
+        # Failed tasks are stored for traceability, but they are excluded
+        # from everywhere unless explicitly requested
+        self._since_time_outdated = True
 
     def is_empty(self):
         """Returns whether there are no remaining tasks in the queue
@@ -301,53 +712,109 @@ class ServerQueueUtility(object):
         return self.__len__() <= 0
 
     def is_busy(self):
-        """Returns whether a task is being processed
+        """Returns whether the max number of tasks to process at the same time
+        has been reached. Consumers process their running tasks one after the
+        other, so only one task per consumer is taken into account
+        """
+        return len(self._consumers) >= self._limiter.get_limit()
+
+    def get_concurrency(self):
+        """Returns a dict with the max number of tasks to process at the same
+        time, its bounds, the average number of seconds tasks take to be
+        processed and the history of changes of the max number of tasks
         """
-        running = filter(lambda t: t.status == "running", self._tasks)
-        return len(running) >= MAX_CONCURRENT_TASKS
+        min_limit, max_limit = get_concurrency_bounds()
+        return {
+            "limit": self._limiter.get_limit(),
+            "min": min_limit,
+            "max": max_limit,
+            "latency": self._limiter.get_latency(),
+            "history": self._limiter.get_history(),
+        }
+
+    def get_metrics(self):
+        """Returns the registry with the counters and histograms of the events
+        of the queue, with the gauges of the current state of the queue
+        updated
+        :rtype: senaite.queue.server.metrics.MetricsRegistry
+        """
+        for status in ["queued", "running", "failed"]:
+            num_tasks = len(self.get_pool(status))
+            self._metrics.set("tasks", num_tasks, status=status)
+        self._metrics.set("concurrency_limit", self._limiter.get_limit())
+        return self._metrics
 
     def purge(self):
-        """Purges running tasks that got stuck for too long
+        """Re-queues the running tasks of the consumers whose lease expired
         """
-        with self.__lock:
+        with self.__lock.write():
             self._purge()
 
     def _purge(self):
-        def is_stuck(task):
-            if task.get("status") != "running":
-                return False
-            max_sec = task.get("max_seconds", 60)
-            started = task.get("started", time.time() - max_sec - 1)
-            return started + max_sec < time.time()
+        # Get the consumers that did not renew their lease on time
+        now = time.time()
+        expired = filter(lambda c: self._leases[c] < now, self._leases.keys())
 
-        # Get tasks that got stuck
-        stuck = filter(is_stuck, self._tasks)
+        # Re-queue or add to pool of failed the tasks of these consumers
+        for consumer_id in expired:
+            msg = "Lease expired ({})".format(consumer_id)
+            for task in self._get_consumer_tasks(consumer_id):
+                self._fail(task, error_message=msg)
+            self._leases.pop(consumer_id, None)
 
-        # Re-queue or add to pool of failed
-        map(lambda t: self._timeout(t), stuck)
+    def _done(self, task, batch_size=1):
+        """Notifies the concurrency limiter that the running task passed-in
+        has been processed successfully, along with batch_size - 1 tasks that
+        were popped together and processed one after the other
+        """
+        if not task or task.status != "running" or not task.get("started"):
+            return
+        # More tasks at a time, unless the task took longer than usual
+        latency = (time.time() - task.get("started")) / max(batch_size, 1)
+        self._limiter.on_done(latency)
+
+        labels = {"name": task.name, "consumer": task.get("consumer_id")}
+        self._metrics.inc("tasks_done", **labels)
+        self._metrics.observe("run_seconds", latency, **labels)
+
+    def _fail(self, task, error_message=None, event="fail", **kwargs):
+        if task.status == "running":
+            # Less tasks at a time, for less chance of conflicts
+            self._limiter.on_fail()
+
+        labels = {"name": task.name, "consumer": task.get("consumer_id")}
+        if event == "timeout":
+            self._metrics.inc("tasks_timeout", **labels)
+        else:
+            self._metrics.inc("tasks_failed", **labels)
+        if is_conflict_error(error_message):
+            self._metrics.inc("conflict_errors", **labels)
+        if task.retries > 0:
+            self._metrics.inc("tasks_retried", name=task.name)
 
-    def _fail(self, task, error_message=None):
         if task.retries > 0:
-            # Update the status of the task. Note we directly update the task,
-            # cause is a reference to the object stored in self._tasks
+            # Update the status of the task. The task stored in self._tasks is
+            # replaced by an updated copy
             # - Reduce the number of remaining retries
             # - Update the create time to make room for other tasks
             # - Reduce the chunk size for less change of a transaction conflict
             # - Add a delay of 5 seconds
-            task.update({
+            kwargs.update({
                 "error_message": error_message,
                 "retries": task.retries - 1,
                 "created": time.time(),
                 "chunk_size": -(-task.get("chunk_size", 10) // 2),
-                "status": "queued",
                 "delay": 5,
             })
+            task = self._set_status(task, "queued", **kwargs)
         else:
             # Consider the task as failed
-            task.update({
-                "status": "failed",
+            kwargs.update({
                 "error_message": error_message
             })
+            task = self._set_status(task, "failed", **kwargs)
+
+        self._record(event, task)
 
         # Update the since time (failed tasks are stored for traceability,
         # but they are excluded from everywhere unless explicitly requested
@@ -358,31 +825,38 @@ class ServerQueueUtility(object):
         # being considered stuck
         max_seconds = task.get("max_seconds", 60)
         max_seconds = int(math.ceil(max_seconds * 1.5))
-        task.update({
-            "max_seconds": max_seconds,
-        })
 
         # Label the task as failed
-        self._fail(task, error_message="Timeout")
+        self._fail(task, error_message="Timeout", event="timeout",
+                   max_seconds=max_seconds)
 
-    def _delete(self, task_uid):
-        task = self.get_task(task_uid)
+    def _delete(self, task_uid, event="delete"):
+        task = self._tasks.pop(task_uid, None)
         if not task:
             return
-        idx = self._tasks.index(task)
-        del(self._tasks[idx])
+        self._unindex_uids(task)
+        self._set_status(task, None)
+        self._sort_keys.pop(task_uid, None)
+        self._record(event, None, task_uid=task_uid)
         self.update_since_time()
 
-    def _add(self, task):
-        # Only QueueTask type is supported
-        if not is_task(task):
-            raise ValueError("{} is not supported".format(repr(task)))
+    def _get_pending_tasks(self):
+        """Returns the tasks added in the current transaction that are pending
+        to be added to the queue on commit
+        """
+        return get_pending_tasks(self._flush)
 
+    def _can_add(self, task):
+        """Returns whether the task can be added to the queue, tasks pending to
+        be added in the current transaction included
+        """
         # Don't add to the queue if the task is already in there
-        if task in self._tasks:
+        pending = self._get_pending_tasks()
+        pending_uids = map(lambda t: t.task_uid, pending)
+        if task.task_uid in self._tasks or task.task_uid in pending_uids:
             logger.warn("Task {} ({}) in the queue already"
                         .format(task.name, task.task_short_uid))
-            return None
+            return False
 
         # Do not add the task if unique and task for same context and name,
         # but do not consider tasks that are either failed or are currently
@@ -392,18 +866,38 @@ class ServerQueueUtility(object):
             skip = ["failed", "running"]
             query = {"context_uid": task.context_uid, "name": task.name}
             existing = self.search(query)
+            existing.extend(filter(lambda t: all([
+                t.context_uid == task.context_uid,
+                t.name == task.name,
+            ]), pending))
             existing = filter(lambda t: t.status not in skip, existing)
             if existing:
                 logger.debug("Task {} for {} in the queue already".format(
                         task.name, task.context_path))
-                return None
+                return False
 
-        # Update task status and append to the list of tasks
-        task.update({"status": "queued"})
-        self._tasks.append(task)
+        return True
 
-        # Sort by priority + created reverse
-        self._tasks = sorted(self._tasks, cmp=self.cmp_tasks)
+    def _add(self, task):
+        # Only QueueTask type is supported
+        if not is_task(task):
+            raise ValueError("{} is not supported".format(repr(task)))
+
+        # The state of the queue might have changed since the task was added
+        # in the transaction, so check again
+        if not self._can_add(task):
+            return None
+
+        # Append a frozen copy to the list of tasks and update task status.
+        # The task passed-in is not modified
+        task = task.freeze()
+        self._tasks[task.task_uid] = task
+        self._index_uids(task)
+        task = self._set_status(task, "queued")
+        self._record("add", task)
+        self._metrics.inc("tasks_added", name=task.name)
+        if task.get("chunk"):
+            self._metrics.inc("task_chunks", name=task.name)
 
         # Update the since time
         if self._since_time < 0 or self._since_time > task.created:
@@ -421,7 +915,157 @@ class ServerQueueUtility(object):
                     return False
             return True
 
-        return copy.deepcopy(filter(is_match, self._tasks))
+        # Narrow down the candidates with the indexes, if possible
+        with self.__lock.read():
+            if query.get("task_uid"):
+                tasks = filter(None, [self._tasks.get(query["task_uid"])])
+            elif query.get("context_uid"):
+                task_uids = self._uids_index.get(query["context_uid"]) or []
+                tasks = map(self._tasks.get, task_uids)
+            else:
+                tasks = self._tasks.values()
+
+        return filter(is_match, tasks)
+
+    def recover(self):
+        """Restores the tasks from the journal, if configured. Does nothing if
+        the tasks have been recovered already
+        """
+        if self._recovered:
+            return
+        with self.__lock.write():
+            if self._recovered:
+                return
+            for task_dict in self._journal.recover():
+                task = to_task(task_dict)
+                if not is_task(task):
+                    continue
+                task = task.freeze()
+                self._tasks[task.task_uid] = task
+                self._index_uids(task)
+                self._set_status(task, task.status or "queued")
+            self._since_time_outdated = True
+            self._recovered = True
+
+    def _record(self, event, task, task_uid=None):
+        """Appends the event to the journal, if configured. Stores a snapshot
+        of the queue when the journal has grown enough
+        """
+        if self._journal is None:
+            return
+        task_uid = task_uid or task.task_uid
+        try:
+            self._journal.record(event, task_uid, task=task)
+            if self._journal.needs_snapshot():
+                self._journal.snapshot(self._tasks.values())
+        except (IOError, OSError) as e:
+            logger.error("Cannot write to the queue journal: {}".format(e))
+
+    def _set_status(self, task, status, **kwargs):
+        """Sets the status to the task and moves the task to the pool for the
+        new status. Since tasks are frozen, the task stored in the queue is
+        replaced by a copy with the new status and the values from kwargs. If
+        status is None, the task is removed from all pools
+        :return: the task stored in the queue with the new status
+        """
+        task_uid = task.task_uid
+        with self._changed:
+            self._version += 1
+            self._changes.append((self._version, task_uid))
+            self._changed.notify_all()
+
+        running = self._pools["running"].get(task_uid)
+        for pool_id in TASK_POOLS:
+            self._pools[pool_id].pop(task_uid, None)
+        self._heap_seqs.pop(task_uid, None)
+
+        # Remove from running tasks counters
+        if running is not None:
+            self._remove_running(running)
+
+        if not status:
+            return None
+
+        kwargs.update({"status": status})
+        task = task.copy_with(**kwargs)
+        self._tasks[task_uid] = task
+        self._pools[status][task_uid] = task
+        if task.get("ghost"):
+            self._pools["ghost"][task_uid] = task
+
+        if status == "queued":
+            # Add the task to the priority queue
+            self._push_queued(task)
+
+        elif status == "running":
+            # Keep track of the names, paths and consumers of running tasks
+            self._add_running(task)
+
+        return task
+
+    def _add_running(self, task):
+        """Adds the running task to the counters of running tasks
+        """
+        consumer_id = task.get("consumer_id")
+        task_uids = self._consumers.setdefault(consumer_id, set())
+        if not task_uids:
+            self._running_hosts[get_consumer_host(consumer_id)] += 1
+            # Running tasks always have a lease (e.g. recovered tasks)
+            self._leases.setdefault(consumer_id, get_lease_expiry())
+        task_uids.add(task.task_uid)
+        self._running_names[task.name] += 1
+        self._running_paths[self.strip_path(task.context_path)] += 1
+
+    def _remove_running(self, task):
+        """Removes the task from the counters of running tasks
+        """
+        def decrease(counter, key):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+        consumer_id = task.get("consumer_id")
+        task_uids = self._consumers.get(consumer_id)
+        if task_uids is not None:
+            task_uids.discard(task.task_uid)
+            if not task_uids:
+                del self._consumers[consumer_id]
+                self._leases.pop(consumer_id, None)
+                decrease(self._running_hosts, get_consumer_host(consumer_id))
+
+        decrease(self._running_names, task.name)
+        decrease(self._running_paths, self.strip_path(task.context_path))
+
+        # Unblock the queued tasks that were waiting for this one
+        if task.name not in self._running_names:
+            paths = self._blocked_names.get(task.name) or []
+            self._unblock(map(lambda path: (task.name, path), paths))
+        path = self.strip_path(task.context_path)
+        if path not in self._running_paths:
+            names = self._blocked_paths.get(path) or []
+            self._unblock(map(lambda name: (name, path), names))
+
+    def _get_referenced_uids(self, task):
+        """Returns the uids the task refers to: context uid plus uids
+        """
+        return [task.context_uid] + list(filter(None, task.uids))
+
+    def _index_uids(self, task):
+        """Adds the uids the task refers to in the uids index
+        """
+        for uid in self._get_referenced_uids(task):
+            self._uids_index.setdefault(uid, set()).add(task.task_uid)
+
+    def _unindex_uids(self, task):
+        """Removes the uids the task refers to from the uids index
+        """
+        for uid in self._get_referenced_uids(task):
+            task_uids = self._uids_index.get(uid)
+            if task_uids is None:
+                continue
+            task_uids.discard(task.task_uid)
+            if not task_uids:
+                del self._uids_index[uid]
 
     def get_top_priority_tasks(self):
         """Returns the list of task names or actions that have top-priority
@@ -429,33 +1073,28 @@ class ServerQueueUtility(object):
         key = "senaite.queue.top_priority_tasks"
         return capi.get_registry_record(key, default=[])
 
-    def cmp_tasks(self, t1, t2):
-        """Compare two tasks based on their creation time reverse, priority and
-        id of the context
+    def get_sort_key(self, task):
+        """Returns the key to sort the task passed-in by. Tasks with lower
+        keys have precedence over tasks with higher keys
         """
-        # Lower values first
-        def cmp(a, b):
-            return (a > b) - (a < b)
-
-        # Find out the top priority tasks
-        top_tasks = self.get_top_priority_tasks()
-
-        def get_task_index(task):
-            name = task.name
-            if name in top_tasks:
-                return top_tasks.index(name)
-            action = task.get("action")
-            if action in top_tasks:
-                return top_tasks.index(action)
-            return len(top_tasks)
+        key = self._sort_keys.get(task.task_uid)
+        if key is None:
+            key = self._compute_sort_key(task)
+        return key
 
+    def _compute_sort_key(self, task):
+        """Returns a tuple (top_priority_index, priority_time, context_uid)
+        that is used to sort the task passed-in
+        """
         # Give priority to top-priority tasks defined by the user in control
         # panel. Tasks defined in "top_priority_tasks" have priority over the
         # rest ot tasks, regardless of creation time
-        t1_idx = get_task_index(t1)
-        t2_idx = get_task_index(t2)
-        if t1_idx != t2_idx:
-            return cmp(t1_idx, t2_idx)
+        top_tasks = self.get_top_priority_tasks() or []
+        top_idx = len(top_tasks)
+        if task.name in top_tasks:
+            top_idx = top_tasks.index(task.name)
+        elif task.get("action") in top_tasks:
+            top_idx = top_tasks.index(task.get("action"))
 
         # Sort by priority + created reverse
         # We multiply the priority for 300 sec. (5 minutes) and then we sum the
@@ -463,11 +1102,119 @@ class ServerQueueUtility(object):
         # priority at the same time we guarantee older, with low priority
         # tasks don't fall through the cracks.
         # TODO: Make this 300 sec. configurable?
-        t1_num = t1.created + (300 * t1.priority)
-        t2_num = t2.created + (300 * t2.priority)
-        if t1_num != t2_num:
-            return cmp(t1_num, t2_num)
+        priority_time = task.created + (300 * task.priority)
 
         # Created at same second. Ensure the system don't start with another
         # until first for same context is finished
-        return cmp(t1.context_uid, t2.context_uid)
+        return top_idx, priority_time, task.context_uid
+
+    def cmp_tasks(self, t1, t2):
+        """Compare two tasks based on their creation time reverse, priority and
+        id of the context
+        """
+        k1 = self.get_sort_key(t1)
+        k2 = self.get_sort_key(t2)
+        # Lower values first
+        return (k1 > k2) - (k1 < k2)
+
+    def _push_queued(self, task):
+        """Adds the task to the priority queue of queued tasks. The sort key of
+        the task is re-computed, so the task gets the right position in the
+        queue even if it has been re-queued
+        """
+        key = self._compute_sort_key(task)
+        seq = next(self._heap_counter)
+        self._sort_keys[task.task_uid] = key
+        self._heap_seqs[task.task_uid] = seq
+        heapq.heappush(self._heap, (key, seq, task))
+
+        # Get rid of stale entries if they are the majority
+        if len(self._heap) > 2 * len(self._heap_seqs) + 100:
+            self._heap = filter(self._is_valid_entry, self._heap)
+            heapq.heapify(self._heap)
+
+    def _is_valid_entry(self, entry):
+        """Returns whether the heap entry passed in still represents a task
+        that is queued
+        """
+        key, seq, task = entry
+        return self._heap_seqs.get(task.task_uid) == seq
+
+    def _pop_queued(self):
+        """Removes and returns the queued task with the highest priority that
+        can be processed, if any. The tasks that cannot be processed yet are
+        put aside until they can, so they are not checked again on next pops
+        """
+        # Restore the delayed tasks that are ready
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            entry = heapq.heappop(self._delayed)[2]
+            if self._is_valid_entry(entry):
+                heapq.heappush(self._heap, entry)
+
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if not self._is_valid_entry(entry):
+                # The task is no longer queued or has been re-queued
+                continue
+
+            # Wait some secs before a task is available for pop (e.g. a task
+            # that failed is not retried immediately)
+            key, seq, task = entry
+            delay = capi.to_int(task.get("delay"), default=0)
+            if task.created + delay > now:
+                heapq.heappush(self._delayed,
+                               (task.created + delay, seq, entry))
+                continue
+
+            # Be sure there is no other consumer working in a same type of
+            # task and for the same path. Tasks popped already in this same
+            # batch are running too
+            path = self.strip_path(task.context_path)
+            if path and task.name in self._running_names and \
+                    path in self._running_paths:
+                self._block(entry, task.name, path)
+                continue
+
+            del self._heap_seqs[task.task_uid]
+            return task
+
+        return None
+
+    def _block(self, entry, name, path):
+        """Puts the heap entry passed-in aside until there are no running
+        tasks with the name or the path passed-in
+        """
+        self._blocked.setdefault((name, path), []).append(entry)
+        self._blocked_names.setdefault(name, set()).add(path)
+        self._blocked_paths.setdefault(path, set()).add(name)
+
+    def _unblock(self, keys):
+        """Restores the heap entries put aside for the (name, path) keys
+        passed-in, if still valid
+        """
+        def discard(index, key, value):
+            values = index.get(key)
+            if values is not None:
+                values.discard(value)
+                if not values:
+                    del index[key]
+
+        for name, path in list(keys):
+            entries = self._blocked.pop((name, path), [])
+            discard(self._blocked_names, name, path)
+            discard(self._blocked_paths, path, name)
+            for entry in filter(self._is_valid_entry, entries):
+                heapq.heappush(self._heap, entry)
+
+    def _rebuild_queued(self):
+        """Re-computes the sort keys of the queued tasks and rebuilds the
+        priority queue from scratch
+        """
+        self._heap = []
+        self._heap_seqs = {}
+        self._delayed = []
+        self._blocked = {}
+        self._blocked_names = {}
+        self._blocked_paths = {}
+        map(self._push_queued, self.get_pool("queued").values())
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from six.moves.http_cookiejar import DefaultCookiePolicy
+
+from bika.lims import api
+
+# Default number of connections to keep alive per host
+POOL_SIZE = 10
+
+# Default number of retries on connection errors
+MAX_RETRIES = 3
+
+# Backoff factor between consecutive retries, in seconds
+BACKOFF_FACTOR = 0.2
+
+_session = None
+_session_settings = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=None, max_retries=None):
+    """Returns the HTTP session shared by all the threads of this zeo client
+    for the requests against the queue server and consumers, so connections
+    are kept alive and reused instead of opening a new one on each request.
+    The session is re-created if the settings passed-in differ from those of
+    the current session, and the replaced session is closed
+    :param pool_size: (Optional) number of connections to keep alive per host.
+        If None, the pool size of the current session is kept
+    :param max_retries: (Optional) number of retries on connection errors. If
+        None, the max retries of the current session are kept
+    :return: the shared session
+    :rtype: requests.Session
+    """
+    global _session
+    global _session_settings
+
+    with _session_lock:
+        current = _session_settings or (POOL_SIZE, MAX_RETRIES)
+        if pool_size is None:
+            pool_size = current[0]
+        if max_retries is None:
+            max_retries = current[1]
+
+        settings = (pool_size, max_retries)
+        if _session is None or settings != _session_settings:
+            if _session is not None:
+                # Release the connections kept alive by the replaced session.
+                # Connections in use by other threads are closed when
+                # released, instead of being returned to the pool
+                _session.close()
+            _session = new_session(pool_size, max_retries)
+            _session_settings = settings
+        return _session
+
+
+def new_session(pool_size=POOL_SIZE, max_retries=MAX_RETRIES):
+    """Returns a new HTTP session with a pool of keep-alive connections and
+    retries with backoff on connection errors
+    :param pool_size: number of connections to keep alive per host
+    :param max_retries: number of retries on connection errors
+    :rtype: requests.Session
+    """
+    # Only retry when the connection could not be established. The request
+    # did not reach the server, so is safe to retry non-idempotent requests
+    retry = Retry(total=max_retries, connect=max_retries, read=0, status=0,
+                  backoff_factor=BACKOFF_FACTOR)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # Requests are sent on behalf of different users, do not keep cookies
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_pool_size(default=POOL_SIZE):
+    """Returns the number of connections to keep alive per host
+    """
+    registry_id = "senaite.queue.http_pool_size"
+    pool_size = api.get_registry_record(registry_id)
+    pool_size = api.to_int(pool_size, default=default)
+    return pool_size >= 1 and pool_size or default
+
+
+def get_max_retries(default=MAX_RETRIES):
+    """Returns the number of retries on connection errors
+    """
+    registry_id = "senaite.queue.http_max_retries"
+    max_retries = api.get_registry_record(registry_id)
+    max_retries = api.to_int(max_retries, default=default)
+    if max_retries < 0:
+        return default
+    return max_retries
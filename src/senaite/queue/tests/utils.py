@@ -39,7 +39,8 @@ from bika.lims.workflow import doActionFor as do_action_for
 
 def handle_action(context, items_or_uids, action):
     """Simulates the handling of an action when multiple items from a list are
-    selected and the action button is pressed
+    selected and the action button is pressed. The transaction is committed
+    afterwards, as the publisher does at the end of the request
     """
     if not isinstance(items_or_uids, (list, tuple)):
         items_or_uids = [items_or_uids]
@@ -48,6 +49,7 @@ def handle_action(context, items_or_uids, action):
     request.set("workflow_action", action)
     request.set("uids", items_or_uids)
     WorkflowActionHandler(context, request)()
+    transaction.commit()
 
 
 def create_sample(services, client, contact, sample_type, receive=True):
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.QUEUE.
+#
+# SENAITE.QUEUE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019-2021 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from senaite.queue import logger
+from senaite.queue import PROFILE_ID
+
+
+def setup_http_settings(tool):
+    """Re-imports the registry for the new fields "http_pool_size" and
+    "http_max_retries" from Queue control panel to take effect
+    """
+    logger.info("Setup HTTP connections settings ...")
+    portal = tool.aq_inner.aq_parent
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(PROFILE_ID, "plone.app.registry")
+    logger.info("Setup HTTP connections settings [DONE]")
+
+
+def setup_consumer_workers(tool):
+    """Re-imports the registry for the new field "consumer_workers" from Queue
+    control panel to take effect
+    """
+    logger.info("Setup consumer workers ...")
+    portal = tool.aq_inner.aq_parent
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(PROFILE_ID, "plone.app.registry")
+    logger.info("Setup consumer workers [DONE]")
+
+
+def setup_consumer_prefetch(tool):
+    """Re-imports the registry for the new field "consumer_prefetch" from
+    Queue control panel to take effect
+    """
+    logger.info("Setup consumer prefetch ...")
+    portal = tool.aq_inner.aq_parent
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(PROFILE_ID, "plone.app.registry")
+    logger.info("Setup consumer prefetch [DONE]")
+
+
+def setup_concurrency_bounds(tool):
+    """Re-imports the registry for the new fields "min_concurrency" and
+    "max_concurrency" from Queue control panel to take effect
+    """
+    logger.info("Setup concurrency bounds ...")
+    portal = tool.aq_inner.aq_parent
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(PROFILE_ID, "plone.app.registry")
+    logger.info("Setup concurrency bounds [DONE]")
+
+
+def setup_long_poll_clients(tool):
+    """Re-imports the registry for the new field "long_poll_clients" from
+    Queue control panel to take effect
+    """
+    logger.info("Setup long-polling clients ...")
+    portal = tool.aq_inner.aq_parent
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(PROFILE_ID, "plone.app.registry")
+    logger.info("Setup long-polling clients [DONE]")